@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Per keystroke latency of the --filter tag picker.
+
+Types a few queries one character at a time against a synthetic tag list,
+narrowing from the previous result like the picker does, and checks every
+result against a plain scan.
+
+    python benchmarks/bench_filter.py [NUMBER_OF_TAGS]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import mssh_menu  # noqa: E402
+from bench_layout import synthetic_tags  # noqa: E402
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    tagslist = synthetic_tags(total)
+    folded = [tag.casefold() for tag in tagslist]
+    start = time.perf_counter()
+    trigrams = mssh_menu.build_trigram_index(folded)
+    build = time.perf_counter() - start
+    print(f'{total} tags, trigram index built in {build*1000:.1f} ms')
+    queries = {tagslist[total // 2][:8], tagslist[7][2:9], 'ab c', 'x'}
+    for query in sorted(queries):
+        results, worst = list(range(total)), 0.0
+        for i in range(1, len(query) + 1):
+            start = time.perf_counter()
+            results = mssh_menu.filter_tags(
+                query[:i], folded, trigrams, results)
+            worst = max(worst, time.perf_counter() - start)
+        terms = query.casefold().split()
+        expected = [
+            n for n, tag in enumerate(folded) if all(t in tag for t in terms)
+            ]
+        assert results == expected, query
+        start = time.perf_counter()
+        assert mssh_menu.filter_tags(query, folded, trigrams) == expected
+        cold = time.perf_counter() - start
+        print(
+            f'{query!r:>12}: {len(results):>6} matches, worst keystroke '
+            f'{worst*1000:.2f} ms, from index {cold*1000:.2f} ms'
+            )
+
+
+if __name__ == '__main__':
+    main()
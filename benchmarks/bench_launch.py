@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Checks the --rate/--burst/--jitter pane launch schedule against a fake
+tmux and a fake ssh which record when each connection starts.
+
+The fake tmux runs the shell command of every split-window in the
+background and exits at once, like a real tmux client would hand the
+panes to its server. The fake ssh appends a timestamp and its host to a
+log.
+
+    python benchmarks/bench_launch.py [HOSTS] [RATE] [BURST] [JITTER]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import mssh_menu  # noqa: E402
+
+FAKE_TMUX = '''\
+#!{python}
+import subprocess, sys
+command = []
+for arg in sys.argv[1:] + [';']:
+    if arg != ';':
+        command.append(arg)
+        continue
+    if command[:1] == ['split-window']:
+        subprocess.Popen(['sh', '-c', command[-1]], start_new_session=True)
+    command = []
+'''
+
+FAKE_SSH = '''\
+#!/bin/sh
+for host; do :; done
+echo "$(date +%s.%N) ${{host#*@}}" >> "{log}"
+'''
+
+
+def fake_bin(d, log):
+    """Writes the fake tmux and ssh to directory d"""
+    for name, text in (('tmux', FAKE_TMUX), ('ssh', FAKE_SSH)):
+        path = os.path.join(d, name)
+        with open(path, 'w') as f:
+            f.write(text.format(python=sys.executable, log=log))
+        os.chmod(path, 0o755)
+
+
+def main():
+    argv = sys.argv[1:]
+    count = int(argv[0]) if len(argv) > 0 else 200
+    rate = float(argv[1]) if len(argv) > 1 else 50.0
+    burst = int(argv[2]) if len(argv) > 2 else 10
+    jitter = float(argv[3]) if len(argv) > 3 else 0.05
+    hosts = [f'host{n}' for n in range(count)]
+    random.seed(0)
+    delays = mssh_menu.launch_delays(count, rate, burst, jitter)
+    planned = dict(zip(hosts, delays))
+    commands = mssh_menu.tmux_session_commands(
+        hosts, 'user', 'bench', max_panes=64, delays=delays,
+        )
+    with tempfile.TemporaryDirectory() as d:
+        log = os.path.join(d, 'starts.log')
+        fake_bin(d, log)
+        os.environ['PATH'] = f'{d}{os.pathsep}{os.environ["PATH"]}'
+        start = time.time()
+        mssh_menu.tmux_run(commands)
+        returned = time.time() - start
+        deadline = time.monotonic() + max(delays) + 10
+        starts = {}
+        while len(starts) < count and time.monotonic() < deadline:
+            time.sleep(0.1)
+            if os.path.exists(log):
+                with open(log) as f:
+                    starts = {
+                        host: float(t) - start
+                        for t, host in map(str.split, f)
+                        }
+    assert len(starts) == count, f'{len(starts)}/{count} started'
+    late = [starts[host] - planned[host] for host in hosts]
+    times = sorted(starts.values())
+    window = 1.0
+    peak = max(
+        sum(1 for t in times[i:] if t < first + window)
+        for i, first in enumerate(times)
+        )
+    print(
+        f'{count} hosts, rate {rate}/s, burst {burst}, jitter {jitter}s\n'
+        f'tmux_run returned after {returned*1000:.1f} ms\n'
+        f'last connection at {times[-1]:.2f} s '
+        f'(planned {max(delays):.2f} s)\n'
+        f'most started in any {window:g} s: {peak} '
+        f'(limit {burst + rate * window:g})\n'
+        f'start lag behind plan: min {min(late)*1000:.0f} ms, '
+        f'max {max(late)*1000:.0f} ms'
+        )
+    assert min(late) > -0.01, 'a connection started early'
+    assert peak <= burst + rate * window + 1, 'rate exceeded'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Benchmark the menu layout (make_table) over synthetic tag lists.
+Also checks the output is identical to the original column search.
+"""
+
+import math
+import pathlib
+import random
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import mssh_menu
+
+
+def reference_optimal_number_of_columns(items, sep, width):
+    """The original search: rebuilds the table for every column count"""
+    for n, _ in enumerate(items, 2):
+        table = mssh_menu.horizontal_table(items, n, sep)
+        if not mssh_menu.do_items_fit(table, width):
+            return n-1
+
+
+def synthetic_tags(count, seed=0, min_len=3, max_len=24):
+    """Returns a list of random tag names"""
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz0123456789-'
+    return [
+        ''.join(rng.choices(letters, k=rng.randint(min_len, max_len)))
+        for _ in range(count)
+        ]
+
+
+def timeit(func, *args, repeat=3):
+    """Returns the best wall time of func(*args) in seconds"""
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    sep = '  '
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for count in (100, 1000, 5000, 20000):
+        items = mssh_menu.format_items(synthetic_tags(count, seed=count))
+        new = mssh_menu.optimal_number_of_columns(items, sep, width)
+        ref = reference_optimal_number_of_columns(items, sep, width)
+        assert new == ref, (count, new, ref)
+        new_table = mssh_menu.format_table(
+            mssh_menu.horizontal_table(items, new, sep))
+        ref_table = mssh_menu.format_table(
+            mssh_menu.horizontal_table(items, ref, sep))
+        assert new_table == ref_table
+        t_new = timeit(mssh_menu.optimal_number_of_columns, items, sep, width)
+        t_ref = timeit(reference_optimal_number_of_columns, items, sep, width)
+        print(
+            f'{count:>6} tags  columns={new:<3} '
+            f'new={t_new*1000:9.3f} ms  reference={t_ref*1000:9.3f} ms'
+            )
+
+
+if __name__ == '__main__':
+    main()
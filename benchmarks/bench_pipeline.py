@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Time each stage of the parse -> index -> layout -> launch pipeline over
+synthetic inventories (see inventory.py).
+
+Stages run in-process against a private HOME and a fixed terminal size
+(COLUMNS x LINES) so layout timings are reproducible. subprocess.run is
+replaced by a fake which counts spawns instead of starting tmux.
+Results are JSON; pass an earlier result with --compare to print the
+ratio per stage and exit non-zero if any stage is slower than
+--max-slowdown. Compare results from the same machine, when idle.
+
+    python benchmarks/bench_pipeline.py [--out FILE] [--compare FILE]
+"""
+
+import argparse
+import atexit
+import contextlib
+import json
+import math
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+terminal = (200, 50)
+home = tempfile.mkdtemp(prefix='mssh-bench-')
+atexit.register(shutil.rmtree, home, True)
+os.environ.update(
+    HOME=home, COLUMNS=str(terminal[0]), LINES=str(terminal[1]),
+    )
+
+import mssh_menu  # noqa: E402
+from inventory import write_inventory  # noqa: E402
+
+cases = {
+    'small': dict(rows=1000, tags_per_row=3, cardinality=100, name_length=12),
+    'wide': dict(rows=10000, tags_per_row=8, cardinality=5000, name_length=24),
+    'long': dict(rows=200000, tags_per_row=3, cardinality=1000, name_length=8),
+    }
+
+
+@contextlib.contextmanager
+def fake_spawns():
+    """Replaces subprocess.run with a fake. Yields the list of argvs"""
+    spawns = []
+    real = subprocess.run
+
+    def run(argv, *args, **kwargs):
+        spawns.append(argv)
+        return subprocess.CompletedProcess(argv, 0, stdout='', stderr='')
+
+    subprocess.run = run
+    try:
+        yield spawns
+    finally:
+        subprocess.run = real
+
+
+def measure(func, repeat, min_time=0.2):
+    """Returns the best wall time in seconds of func() and its spawns.
+    Runs it at least repeat times and for at least min_time seconds, so
+    fast stages get enough samples for a stable best time
+    """
+    best = math.inf
+    total = 0.0
+    runs = 0
+    while runs < repeat or (total < min_time and runs < 1000):
+        with fake_spawns() as spawns:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+        runs += 1
+    return {'seconds': best, 'runs': runs, 'spawns': len(spawns)}
+
+
+def run_case(path, repeat):
+    """Returns the timings of each stage for one csv file"""
+    path = pathlib.Path(path)
+    rows = mssh_menu.open_csv(path)
+    hosts, tagsdict = mssh_menu.build_tag_index(rows)
+    tagslist = mssh_menu.natural_sort(tagsdict)
+    mssh_menu.load_inventory(path, rebuild=True)
+    inventory = mssh_menu.Inventory(hosts, tagslist, tagsdict)
+    items = mssh_menu.format_items(tagslist)
+    selection = inventory.resolve('1-3')[:500]
+    stages = {
+        'parse': lambda: mssh_menu.open_csv(path),
+        'index': lambda: mssh_menu.build_tag_index(rows),
+        'sort': lambda: mssh_menu.natural_sort(tagsdict),
+        'cache': lambda: mssh_menu.load_inventory(path),
+        'resolve': lambda: (
+            mssh_menu.Inventory(hosts, tagslist, tagsdict).resolve('1-3'),
+            mssh_menu.Inventory(hosts, tagslist, tagsdict).resolve('1 & 2'),
+            ),
+        'layout': lambda: mssh_menu.make_table(items, pad_lines=5),
+        'launch': lambda: mssh_menu.mssh_using_tmux(
+            selection, 'user', max_panes=64, reuse=False,
+            ),
+        }
+    return {
+        'hosts': len(hosts),
+        'tags': len(tagslist),
+        'launch_panes': len(selection),
+        'stages': {name: measure(f, repeat) for name, f in stages.items()},
+        }
+
+
+def compare(results, baseline, max_slowdown):
+    """Prints the ratio of each stage to the baseline. Returns the list of
+    stages slower than max_slowdown
+    """
+    slower = []
+    for case, result in results['cases'].items():
+        old = baseline['cases'].get(case, {}).get('stages', {})
+        for stage, new in result['stages'].items():
+            if stage not in old:
+                continue
+            ratio = new['seconds'] / max(old[stage]['seconds'], 1e-9)
+            flag = ''
+            if ratio > max_slowdown:
+                slower.append(f'{case}.{stage}')
+                flag = '  <-- slower'
+            if new['spawns'] != old[stage]['spawns']:
+                flag += f"  spawns {old[stage]['spawns']} -> {new['spawns']}"
+            print(f'{case:>6} {stage:<8} {ratio:6.2f}x{flag}')
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--case', action='append', choices=list(cases))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', help='Write the JSON results to a file.')
+    parser.add_argument('--compare', help='An earlier JSON result.')
+    parser.add_argument('--max-slowdown', type=float, default=1.5)
+    args = parser.parse_args()
+    results = {
+        'version': mssh_menu.__version__,
+        'python': platform.python_version(),
+        'terminal': terminal,
+        'repeat': args.repeat,
+        'cases': {},
+        }
+    for name in args.case or cases:
+        path = os.path.join(home, f'{name}.csv')
+        write_inventory(path, **cases[name])
+        results['cases'][name] = {
+            'params': cases[name], **run_case(path, args.repeat),
+            }
+    text = json.dumps(results, indent=2)
+    if args.out:
+        pathlib.Path(args.out).write_text(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        baseline = json.loads(pathlib.Path(args.compare).read_text())
+        if slower := compare(results, baseline, args.max_slowdown):
+            print(f'Slower than {args.max_slowdown}x: {", ".join(slower)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
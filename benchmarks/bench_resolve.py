@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Checks --resolve against a stubbed resolver which takes LATENCY seconds
+per lookup and counts the lookups in flight.
+
+Resolves HOSTS names with at most LIMIT concurrent lookups, then again
+from the cache. A name which fails and one which doesn't answer within
+the timeout must be left out, for ssh to look them up itself.
+
+    python benchmarks/bench_resolve.py [HOSTS] [LIMIT] [LATENCY]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import mssh_menu  # noqa: E402
+
+
+class StubResolver:
+    """Returns a made up address per host after latency seconds"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.running = 0
+        self.peak = 0
+
+    def __call__(self, host):
+        with self.lock:
+            self.calls += 1
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            time.sleep(5 if host == 'slow.example.com' else self.latency)
+            if host == 'missing.example.com':
+                raise OSError(-2, 'Name or service not known')
+            n = int(host.removeprefix('host').partition('.')[0])
+            return f'10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}'
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def main():
+    argv = sys.argv[1:]
+    count = int(argv[0]) if len(argv) > 0 else 500
+    limit = int(argv[1]) if len(argv) > 1 else 16
+    latency = float(argv[2]) if len(argv) > 2 else 0.02
+    hosts = [f'host{n}.example.com' for n in range(count)]
+    hosts += ['missing.example.com', '192.0.2.1']
+    with tempfile.TemporaryDirectory() as d:
+        cache = os.path.join(d, 'dns.json')
+        stub = StubResolver(latency)
+        start = time.perf_counter()
+        first = mssh_menu.resolve_hosts(
+            hosts, limit, resolver=stub, f=cache,
+            )
+        cold = time.perf_counter() - start
+        lookups = stub.calls
+        start = time.perf_counter()
+        second = mssh_menu.resolve_hosts(
+            hosts[:count], limit, resolver=stub, f=cache,
+            )
+        warm = time.perf_counter() - start
+        relookups = stub.calls - lookups
+        start = time.perf_counter()
+        slow = mssh_menu.resolve_hosts(
+            ['slow.example.com', 'host0.example.org'], limit, timeout=1.0,
+            resolver=stub, f=cache,
+            )
+        waited = time.perf_counter() - start
+    print(
+        f'{count} hosts, limit {limit}, {latency*1000:g} ms per lookup\n'
+        f'cold: {cold*1000:.0f} ms, {lookups} lookups, '
+        f'at most {stub.peak} at once '
+        f'(ideal {count * latency / limit * 1000:.0f} ms)\n'
+        f'warm: {warm*1000:.1f} ms, {relookups} lookups\n'
+        f'1 s timeout: returned after {waited*1000:.0f} ms'
+        )
+    assert len(first) == count, f'{len(first)}/{count} resolved'
+    assert 'missing.example.com' not in first, 'failed lookup kept'
+    assert '192.0.2.1' not in first, 'address looked up'
+    assert stub.peak <= limit, 'concurrency limit exceeded'
+    assert second == first and not relookups, 'cache not used'
+    assert list(slow) == ['host0.example.org'], 'timed out lookup kept'
+    assert waited < 1.5, 'timeout not kept'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Measure cold start of the fast paths with `python -X importtime`.
+Exits non-zero when the cumulative import time of any path is above the
+cap, so it can be used as a startup regression check.
+
+The complete-tags path is what each Tab press after `-n` runs. It
+completes the menu of a synthetic inventory (see inventory.py) whose tag
+names sidecar is built first, and has a cap of its own.
+"""
+
+import argparse
+import atexit
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+home = tempfile.mkdtemp(prefix='mssh-bench-')
+atexit.register(shutil.rmtree, home, True)
+os.environ['HOME'] = home
+
+import mssh_menu  # noqa: E402
+from inventory import write_inventory  # noqa: E402
+
+script = pathlib.Path(__file__).resolve().parent.parent / 'mssh_menu.py'
+inventory = pathlib.Path(home, 'inventory.csv')
+
+paths = {
+    'completion': ['--completion', 'bash'],
+    'version': ['--version'],
+    'complete-tags': ['--complete-tags', str(inventory), '-n', '1,'],
+    }
+
+
+def import_time_us(argv):
+    """Runs the script with -X importtime. Returns the total import time
+    in microseconds and the slowest top level imports
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', str(script), *argv],
+        capture_output=True,
+        text=True,
+        )
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.removeprefix('import time:').split('|')
+        if not name.startswith('  '):
+            # Top level import, not one nested inside another
+            imports.append((int(cumulative), name.strip()))
+    return sum(us for us, _ in imports), sorted(imports, reverse=True)[:5]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--max-ms',
+        type=float,
+        default=40.0,
+        help='Fail if the imports of a path take longer (default=40)',
+        )
+    parser.add_argument(
+        '--max-complete-ms',
+        type=float,
+        default=20.0,
+        help='Fail if the imports of complete-tags take longer (default=20)',
+        )
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--cardinality', type=int, default=3000)
+    args = parser.parse_args()
+    write_inventory(inventory, rows=args.rows, cardinality=args.cardinality)
+    mssh_menu.load_inventory(inventory)
+    assert mssh_menu.read_tags_index(inventory), 'no tag names sidecar'
+    caps = {'complete-tags': args.max_complete_ms}
+    failed = False
+    for name, argv in paths.items():
+        total, slowest = min(import_time_us(argv) for _ in range(5))
+        failed |= total / 1000 > caps.get(name, args.max_ms)
+        top = ', '.join(f'{mod} {us/1000:.1f}' for us, mod in slowest)
+        print(f'{name:<14} {total/1000:7.1f} ms imports  ({top})')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Checks the -n completion of command lines with one or several csv
+files, globs and directories, given in any place among other options.
+
+Also checks _value_options holds the options of the parser which take
+a value, since --complete-tags picks out the FILENAME.CSV words without
+building the parser.
+
+    python benchmarks/check_complete_tags.py
+"""
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+home = tempfile.mkdtemp(prefix='mssh-complete-')
+os.environ['HOME'] = home
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import mssh_menu  # noqa: E402
+
+SERVERS = ['All', 'Primary', 'Redundant', 'Site 1', 'Site 2']
+OTHER = ['All', 'Lab', 'Primary']
+
+
+def complete(words):
+    """Returns the completion lines of a command line"""
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        mssh_menu.complete_tags(list(words))
+    return out.getvalue().splitlines()
+
+
+def menu(tags, head=''):
+    """Returns the completion lines of a menu"""
+    return [f'{head}{n}\t{tag}' for n, tag in enumerate(tags, 1)]
+
+
+def main():
+    examples = os.path.join(os.path.dirname(__file__), os.pardir, 'examples')
+    d = os.path.join(home, 'inventories')
+    os.makedirs(d)
+    servers = os.path.join(d, 'servers.csv')
+    other = os.path.join(d, 'other.csv')
+    shutil.copy(os.path.join(examples, 'servers.csv'), servers)
+    shutil.copy(servers, mssh_menu._csv_default)
+    with open(other, 'w') as f:
+        f.write('host,tags\nlab1,Lab,All\nlab2,Lab,Primary\n')
+    merged = mssh_menu.natural_sort(set(SERVERS) | set(OTHER))
+    cases = [
+        ([servers, '-n', ''], menu(SERVERS)),
+        ([servers, '-n', '1,'], menu(SERVERS, '1,')),
+        (['-u', 'bob', servers, '--number', '2'], menu(SERVERS)),
+        (['--max-panes', '4', other, '-n', ''], menu(OTHER)),
+        (['--log-dir=/tmp', '-p', other, '-n', ''], menu(OTHER)),
+        (['-mu', 'bob.csv', other, '-n', ''], menu(OTHER)),
+        (['-mubob', other, '-n', ''], menu(OTHER)),
+        ([servers, other, '-n', ''], menu(merged)),
+        ([other, '-d', servers, '-n', ''], menu(merged)),
+        ([d, '-n', ''], menu(merged)),
+        ([os.path.join(d, '*.csv'), '-n', ''], menu(merged)),
+        (['--', servers, '-n', ''], menu(SERVERS)),
+        (['-n', ''], menu(SERVERS)),
+        ([os.path.join(d, 'missing.csv'), '-n', ''], []),
+        ]
+    failed = []
+    try:
+        for words, expected in cases:
+            if (lines := complete(words)) != expected:
+                failed.append(f'{words}: {lines}')
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+    parser = mssh_menu.parse_arguments()
+    internal = {'--complete-tags', '--log-writer'}
+    options = {
+        o for a in parser._actions if a.nargs != 0
+        for o in a.option_strings if o not in internal
+        }
+    print(f'{len(cases) - len(failed)}/{len(cases)} command lines completed')
+    for line in failed:
+        print(f'  {line}')
+    assert not failed, 'completions differ'
+    assert options == mssh_menu._value_options, (
+        f'_value_options differs from the parser: '
+        f'{options ^ mssh_menu._value_options}'
+        )
+
+
+if __name__ == '__main__':
+    main()
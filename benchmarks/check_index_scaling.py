@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Checks the inverted tag index scales linearly with the inventory.
+
+Builds the index of synthetic inventories (see inventory.py) of 1k, 10k
+and 100k rows with the same tags, checks it against a naive scan of the
+rows, including hosts repeated on later rows, and that the time per row
+grows no more than MAX_GROWTH times from one size to the next.
+
+    python benchmarks/check_index_scaling.py [MAX_GROWTH] [REPEAT]
+"""
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import mssh_menu  # noqa: E402
+from inventory import write_inventory  # noqa: E402
+
+sizes = [1000, 10000, 100000]
+
+
+def naive_index(rows):
+    """Returns the hosts and tag to hosts mapping the slow way"""
+    hosts = list(dict.fromkeys(host for host, *_ in rows))
+    tags = {tag for _, *row_tags in rows for tag in row_tags}
+    return hosts, {
+        tag: [h for h in hosts if any(
+            host == h and tag in row_tags for host, *row_tags in rows
+            )]
+        for tag in tags
+        }
+
+
+def best_time(func, repeat):
+    """Returns the best wall time in seconds of func()"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def check_index(rows):
+    """Asserts the index of rows matches the naive one"""
+    hosts, tagsdict = mssh_menu.build_tag_index(rows)
+    expected_hosts, expected = naive_index(rows)
+    assert hosts == expected_hosts, 'hosts differ from csv order'
+    assert {t: [hosts[i] for i in ids] for t, ids in tagsdict.items()} \
+        == expected, 'tag index differs from the naive scan'
+    tagslist = mssh_menu.natural_sort(tagsdict)
+    selection = [str(n) for n in range(1, len(tagslist) + 1, 3)]
+    selected = mssh_menu.resolve_selection(
+        selection, tagslist, tagsdict, hosts,
+        )
+    union = {h for n in selection for h in expected[tagslist[int(n)-1]]}
+    assert selected == [h for h in hosts if h in union], 'selection differs'
+
+
+def main():
+    argv = sys.argv[1:]
+    max_growth = float(argv[0]) if len(argv) > 0 else 2.5
+    repeat = int(argv[1]) if len(argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'small.csv')
+        write_inventory(path, rows=300, tags_per_row=4, cardinality=40)
+        rows = mssh_menu.open_csv(pathlib.Path(path))
+        # Hosts repeated on later rows, with new and already seen tags
+        rows += [
+            [host, *tags[::-1], f'late{n % 3}']
+            for n, (host, *tags) in enumerate(rows[::7])
+            ]
+        check_index(rows)
+        per_row = []
+        for size in sizes:
+            path = os.path.join(d, f'{size}.csv')
+            write_inventory(path, rows=size, tags_per_row=3, cardinality=1000)
+            rows = mssh_menu.open_csv(pathlib.Path(path))
+            seconds = best_time(
+                lambda: mssh_menu.build_tag_index(rows), repeat,
+                )
+            per_row.append(seconds / size)
+            print(
+                f'{size:>7} rows: {seconds*1000:8.2f} ms, '
+                f'{per_row[-1]*1e9:6.0f} ns per row'
+                )
+    growth = [b / a for a, b in zip(per_row, per_row[1:])]
+    print('time per row grew ' + ', '.join(f'{g:.2f}x' for g in growth))
+    assert max(growth) <= max_growth, 'index build is not linear'
+
+
+if __name__ == '__main__':
+    main()
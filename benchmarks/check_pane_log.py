@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Checks the --log-dir writer: feeds terminal output with colours,
+titles, DCS strings, carriage returns and a line longer than the cap to
+a PaneLog in random chunks, then checks the segments hold exactly the
+text, in order, and none is larger than MAX_BYTES.
+
+    python benchmarks/check_pane_log.py [ROUNDS] [MAX_BYTES] [SEED]
+"""
+import glob
+import gzip
+import os
+import random
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import mssh_menu  # noqa: E402
+
+# (raw bytes, text left in the log) of the escapes mixed into the lines
+escapes = [
+    (b'\x1b[1;31m', b''),
+    (b'\x1b[0m', b''),
+    (b'\x1b[2K', b''),
+    (b'\x1b]0;user@host: ~\x07', b''),
+    (b'\x1b]2;title\x1b\\', b''),
+    (b'\x1bPqdcs payload\x1b\\', b''),
+    (b'\x1b(B', b''),
+    (b'\x1b=', b''),
+    (b'\r\n', b'\n'),
+    (b'\x08', b''),
+    ]
+
+
+def terminal_output(rng, lines, max_bytes):
+    """Returns raw output and the text it should leave in the log"""
+    raw = []
+    text = []
+    for n in range(lines):
+        words = [f'line{n}'] + [f'w{rng.randrange(1000)}' for _ in range(8)]
+        if n == lines // 2:
+            words.append('x' * (max_bytes * 2))
+        for word in words:
+            if rng.random() < 0.3:
+                r, t = rng.choice(escapes)
+                raw.append(r)
+                text.append(t)
+            raw.append(word.encode() + b' ')
+            text.append(word.encode() + b' ')
+        raw.append(b'\r\n')
+        text.append(b'\n')
+    return b''.join(raw), b''.join(text)
+
+
+def read_segments(path):
+    """Returns the segments of a log, oldest first"""
+    base = path.removesuffix('.log')
+    numbered = sorted(
+        glob.glob(f'{glob.escape(base)}.*.log.gz'),
+        key=lambda f: int(f[len(base) + 1:].split('.')[0]),
+        )
+    segments = []
+    for f in numbered:
+        with gzip.open(f) as fr:
+            segments.append(fr.read())
+    if os.path.exists(path):
+        with open(path, 'rb') as fr:
+            segments.append(fr.read())
+    return segments
+
+
+def main():
+    argv = sys.argv[1:]
+    rounds = int(argv[0]) if len(argv) > 0 else 50
+    max_bytes = int(argv[1]) if len(argv) > 1 else 1000
+    rng = random.Random(int(argv[2]) if len(argv) > 2 else 0)
+    largest = 0
+    count = 0
+    for _ in range(rounds):
+        raw, text = terminal_output(rng, rng.randrange(20, 200), max_bytes)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'host.log')
+            log = mssh_menu.PaneLog(path, max_bytes)
+            i = 0
+            while i < len(raw):
+                size = rng.choice([1, 2, 3, rng.randrange(1, 200)])
+                log.write(raw[i:i+size])
+                if rng.random() < 0.1:
+                    log.flush()
+                i += size
+            log.flush()
+            for thread in threading.enumerate():
+                if thread is not threading.current_thread():
+                    thread.join()
+            segments = read_segments(path)
+        assert b''.join(segments) == text, 'log text differs from output'
+        largest = max(largest, *map(len, segments))
+        count += len(segments)
+    print(
+        f'{rounds} random chunkings, {count} segments, '
+        f'largest {largest} bytes (cap {max_bytes})'
+        )
+    assert largest <= max_bytes, 'segment larger than the cap'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Checks --probe against local sockets: hosts listening on 127.0.0.1,
+hosts on closed ports, a name which doesn't resolve and hosts which
+never answer (a listening socket whose backlog is full), spread over
+the probe in a random order.
+
+Hosts listening must be up and the others down, in the order given. The
+hosts which never answer take TIMEOUT seconds each, LIMIT at a time.
+
+    python benchmarks/check_probe.py [HOSTS] [LIMIT] [TIMEOUT]
+"""
+import math
+import os
+import random
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import mssh_menu  # noqa: E402
+
+
+def listening(backlog=128):
+    """Returns a socket listening on a free port of 127.0.0.1"""
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    s.listen(backlog)
+    return s
+
+
+def closed_port():
+    """Returns a port of 127.0.0.1 nothing listens on"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    argv = sys.argv[1:]
+    count = int(argv[0]) if len(argv) > 0 else 200
+    limit = int(argv[1]) if len(argv) > 1 else 8
+    timeout = float(argv[2]) if len(argv) > 2 else 0.5
+    sockets = []
+    ports = {}
+    expected = {}
+    for n in range(count):
+        host = f'host{n}'
+        if n % 2:
+            s = listening()
+            sockets.append(s)
+            ports[host] = s.getsockname()[1]
+            expected[host] = True
+        else:
+            ports[host] = closed_port()
+            expected[host] = False
+    # Fill the backlog so further connections are never answered
+    silent = listening(0)
+    fillers = []
+    for _ in range(4):
+        c = socket.socket()
+        c.setblocking(False)
+        c.connect_ex(silent.getsockname())
+        fillers.append(c)
+    time.sleep(0.1)
+    silent_hosts = limit * 2 + 1
+    for n in range(silent_hosts):
+        ports[f'silent{n}'] = silent.getsockname()[1]
+        expected[f'silent{n}'] = False
+    expected['missing.invalid'] = False
+    hosts = list(expected)
+    random.Random(0).shuffle(hosts)
+    addresses = {h: '127.0.0.1' for h in hosts if h != 'missing.invalid'}
+    try:
+        start = time.perf_counter()
+        up, down = mssh_menu.probe_hosts(
+            hosts, timeout=timeout, limit=limit, ports=ports,
+            addresses=addresses,
+            )
+        elapsed = time.perf_counter() - start
+    finally:
+        for s in sockets + fillers + [silent]:
+            s.close()
+    rounds = math.ceil(silent_hosts / limit)
+    print(
+        f'{len(hosts)} hosts, limit {limit}, {timeout:g} s timeout: '
+        f'{len(up)} up, {len(down)} down in {elapsed:.2f} s '
+        f'({silent_hosts} never answer, at least {rounds * timeout:g} s)'
+        )
+    assert up == [h for h in hosts if expected[h]], 'wrong hosts up'
+    assert down == [h for h in hosts if not expected[h]], 'wrong hosts down'
+    assert elapsed >= rounds * timeout * 0.9, 'concurrency limit exceeded'
+    assert elapsed < (rounds + 2) * timeout + 1, 'timeout not kept'
+
+
+if __name__ == '__main__':
+    main()
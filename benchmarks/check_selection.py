@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Checks how -n selections resolve on examples/servers.csv, whose menu is
+1 All, 2 Primary, 3 Redundant, 4 Site 1, 5 Site 2.
+
+A dash between two numbers is a range however it is spaced, as it was
+before the selection language; `~` or a dash next to a tag or a group
+excludes.
+
+    python benchmarks/check_selection.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import mssh_menu  # noqa: E402
+
+ALL = ['server1', 'server2', 'server3', 'server4']
+
+cases = {
+    # Numbers and ranges
+    '1': ALL,
+    '2,3': ALL,
+    '4': ['server1', 'server2'],
+    '1-3': ALL,
+    '1 - 3': ALL,
+    '1- 3': ALL,
+    '1 -3': ALL,
+    '4-5': ALL,
+    '4 - 5, 2': ALL,
+    '2 - 2': ['server1', 'server3'],
+    # Set algebra
+    '4 & 2': ['server1'],
+    '4 ~ 2': ['server2'],
+    '1~2': ['server2', 'server4'],
+    '4 - (2)': ['server2'],
+    '(4) - 2': ['server2'],
+    '1 - Primary': ['server2', 'server4'],
+    '"Site 1" - Primary': ['server2'],
+    'Site 1 ~ Primary': ['server2'],
+    'site 2 & redundant': ['server4'],
+    '(4 | 5) & 3': ['server2', 'server4'],
+    }
+
+invalid = ['5 - 1', '5-1', '0', '6', '1-6', '4 ~', '"Site 1', 'Site 9', '']
+
+
+def main():
+    path = os.path.join(
+        os.path.dirname(__file__), os.pardir, 'examples', 'servers.csv',
+        )
+    inventory = mssh_menu.Inventory.from_csv(path, use_cache=False)
+    failed = []
+    for selection, expected in cases.items():
+        try:
+            hosts = inventory.resolve(selection)
+        except ValueError as e:
+            hosts = e
+        if hosts != expected:
+            failed.append(f'{selection!r}: {hosts} != {expected}')
+    for selection in invalid:
+        try:
+            hosts = inventory.resolve(selection)
+        except ValueError:
+            continue
+        failed.append(f'{selection!r}: {hosts}, expected ValueError')
+    print(f'{len(cases) + len(invalid) - len(failed)}/'
+          f'{len(cases) + len(invalid)} selections as expected')
+    for line in failed:
+        print(f'  {line}')
+    assert not failed, 'selections resolved differently'
+
+
+if __name__ == '__main__':
+    main()
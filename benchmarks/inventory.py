@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Write a synthetic inventory CSV file for the benchmarks.
+
+    python benchmarks/inventory.py OUT.csv [--rows N] [--tags-per-row N]
+        [--cardinality N] [--name-length N] [--seed N]
+
+Hosts are unique. Each row gets up to --tags-per-row tags drawn from
+--cardinality distinct tag names, with a long tail like real inventories
+(a few tags on most rows, most tags on a few rows).
+"""
+
+import argparse
+import random
+import string
+
+
+def tag_names(cardinality, name_length, rng):
+    """Returns cardinality distinct tag names of about name_length"""
+    letters = string.ascii_lowercase + string.digits + '-'
+    names = set()
+    while len(names) < cardinality:
+        length = max(2, int(rng.gauss(name_length, name_length / 4)))
+        names.add(''.join(rng.choices(letters, k=length)))
+    return sorted(names)
+
+
+def write_inventory(
+        path, rows=1000, tags_per_row=3, cardinality=100, name_length=12,
+        seed=0):
+    """Writes a synthetic inventory to path. Returns the path"""
+    import csv
+    rng = random.Random(seed)
+    names = tag_names(cardinality, name_length, rng)
+    # Zipf like weights so some tags cover most hosts
+    weights = [1 / (n + 1) for n in range(cardinality)]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['host', 'tags'])
+        for n in range(rows):
+            k = rng.randint(1, tags_per_row)
+            tags = dict.fromkeys(rng.choices(names, weights, k=k))
+            writer.writerow([f'host{n}.example.com', *tags])
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--tags-per-row', type=int, default=3)
+    parser.add_argument('--cardinality', type=int, default=100)
+    parser.add_argument('--name-length', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_inventory(
+        args.path, args.rows, args.tags_per_row, args.cardinality,
+        args.name_length, args.seed,
+        )
+
+
+if __name__ == '__main__':
+    main()
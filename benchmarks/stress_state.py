@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Stress the state file with many concurrent writers.
+
+PROCESSES runs start at once, spread over FILES csv files, each saving a
+field of its own. The state file is seeded with OLD entries used long
+ago and capped at FILES + OLD/2 entries. Checks the file is valid JSON,
+no run's change was lost, every csv file of the runs is kept and the
+least recently used old entries were dropped.
+
+    python benchmarks/stress_state.py [PROCESSES] [FILES] [OLD]
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+home = tempfile.mkdtemp(prefix='mssh-stress-')
+os.environ['HOME'] = home
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import mssh_menu  # noqa: E402
+
+
+def run(n, csvfile, max_entries, barrier):
+    """One run of the program: saves its changes once all runs are ready"""
+    mssh_menu.csvfile = csvfile
+    mssh_menu._state_changes.update({'user': f'user{n}', f'run{n}': n})
+    barrier.wait()
+    mssh_menu.write_state(max_entries=max_entries)
+
+
+def main():
+    argv = sys.argv[1:]
+    processes = int(argv[0]) if len(argv) > 0 else 200
+    files = int(argv[1]) if len(argv) > 1 else 20
+    old = int(argv[2]) if len(argv) > 2 else 40
+    max_entries = files + old // 2
+    f = mssh_menu._jsoncache
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+    seed = {
+        f'/old/{n}.csv': {'user': 'old', 'last_used': n + 1}
+        for n in range(old)
+        }
+    mssh_menu.write_jsonfile(seed, f)
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(processes)
+    workers = [
+        context.Process(
+            target=run,
+            args=(n, f'/csv/{n % files}.csv', max_entries, barrier),
+            )
+        for n in range(processes)
+        ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    try:
+        assert all(w.exitcode == 0 for w in workers), 'a run failed'
+        with open(f) as fr:
+            state = json.load(fr)
+        lost = [
+            n for n in range(processes)
+            if state.get(f'/csv/{n % files}.csv', {}).get(f'run{n}') != n
+            ]
+        kept_old = sorted(k for k in state if k.startswith('/old/'))
+        expected_old = sorted(f'/old/{n}.csv' for n in range(old // 2, old))
+        leftovers = [
+            name for name in os.listdir(os.path.dirname(f))
+            if name.startswith('.')
+            ]
+        print(
+            f'{processes} runs over {files} csv files in {elapsed:.2f} s: '
+            f'{len(state)} entries (cap {max_entries}), '
+            f'{len(lost)} changes lost, {len(kept_old)}/{old} old kept'
+            )
+        assert not lost, f'changes lost: runs {lost[:10]}'
+        assert len(state) == max_entries, 'cap not kept'
+        assert kept_old == expected_old, 'not the least recently used dropped'
+        assert not leftovers, f'temporary files left: {leftovers}'
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
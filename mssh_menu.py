@@ -15,57 +15,154 @@ __version__ = '0.0.6'
 __date__ = '2025-05-23'
 __info__ = 'Use CSV file with tags to ssh into multiple devices'
 
-import argparse
-import csv
-import datetime as dt
-import importlib.resources
-import json
-import math
-import pathlib
-import re
-import shutil
-import subprocess
+# Only what every code path needs is imported here; other modules (even
+# pathlib) are imported by the functions which use them for fast startup
+import os
 import sys
 
 
-_jsoncache = pathlib.Path.home() / '.local/share/mssh-menu/mssh-menu.json'
-_csv_default = pathlib.Path.home() / 'servers.csv'
+_datadir = os.path.expanduser('~/.local/share/mssh-menu')
+_jsoncache = os.path.join(_datadir, 'mssh-menu.json')
+_pklcache = os.path.join(_datadir, 'inventories')
+_controldir = os.path.join(_datadir, 'control')
+_socket = os.path.join(_datadir, 'mssh-menu.sock')
+_dnscache = os.path.join(_datadir, 'dns.json')
+_csv_default = os.path.expanduser('~/servers.csv')
+# The --version text, used by the parser and by fast_path
+_version = f'Version: %(prog)s  {__version__}  ({__date__})'
+_state = None
+_state_changes = {}
+_state_max_entries = 100
+_inventories = {}
+_served = {}
+# functools.lru_cache of parse_selection_ops, made on first use
+_compiled_selections = None
+_compiled_selections_max = 256
+_bits_table = bytes.maketrans(b'\x00\x01', b'01')
+_selection_ops = {
+    ',': '|', '|': '|', '+': '|', '&': '&', '~': '-', '-': '-',
+    }
+_cache_format = 3
+# Parse csv files in a process pool when more than this needs parsing
+_parallel_min_bytes = 1 << 20
+# Terminal escape sequences (CSI, OSC, DCS and the like, two byte ESC
+# codes) and other control characters dropped from pane logs
+_log_escapes = (
+    rb'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)'
+    rb'|[PX^_][^\x1b]*\x1b\\|[ -/]*[0-OQ-WYZ\\`a-~])'
+    rb'|\r(?!\n)|[\x00-\x08\x0b-\x1f\x7f]'
+    )
+# An escape sequence cut off by the end of the bytes read so far, and the
+# most of one held back for the next read
+_log_partial = (
+    rb'\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?|[PX^_][^\x1b]*\x1b?'
+    rb'|[ -/]*)\Z'
+    )
+_log_partial_max = 4096
+# Pane logs are written once this much is buffered, else every second
+_log_buffer_bytes = 1 << 16
+# Typed csv columns, by header name (lowercase alphanumerics only), and
+# the ssh option each sets for the host on that row
+_host_columns = {
+    'port': 'Port',
+    'user': 'User',
+    'username': 'User',
+    'jump': 'ProxyJump',
+    'jumphost': 'ProxyJump',
+    'proxyjump': 'ProxyJump',
+    'identity': 'IdentityFile',
+    'identityfile': 'IdentityFile',
+    }
+_completion_shells = ['bash', 'zsh', 'fish']
+# Options of parse_arguments which take a value, so --complete-tags can
+# pick out the FILENAME.CSV words without building the parser
+_value_options = {
+    '--completion', '-n', '--number', '-u', '--user', '-c', '--columns',
+    '-s', '--sort', '--page', '-f', '--format', '--probe-port',
+    '--probe-timeout', '--probe-limit', '--exec', '--exec-limit',
+    '--resolve-limit', '--resolve-ttl', '--max-panes', '--rate', '--burst',
+    '--jitter', '--control-persist', '--log-dir', '--log-max-size',
+    '--history-limit', '--profile-trace', '--profile-dump', '--relay',
+    }
+_profile = None
+# Functions (and methods) timed by --profile
+_profiled = [
+    'load_inventory', 'read_inventory_cache', 'parse_inventory',
+    'build_tag_index', 'natural_sort', 'write_inventory_cache',
+    'write_tags_index', 'make_table', 'MenuPager.__init__', 'read_jsonfile',
+    'write_jsonfile', 'write_state', 'check_selection', 'Inventory.from_csv',
+    'Inventory.resolve', 'sort_hosts', 'probe_hosts', 'daemon_request',
+    'tmux_launch_commands', 'tmux_output', 'tmux_run',
+    ]
 
 
 def parse_arguments():
     """Create command line arguments and auto generated help"""
+    import argparse
+    import pathlib
     from argparse import ONE_OR_MORE, OPTIONAL, ZERO_OR_MORE, SUPPRESS
-    completion_parser = argparse.ArgumentParser(add_help=False)
-    completion_group = completion_parser.add_argument_group(
+    parser=argparse.ArgumentParser(
+        prog=__script__,
+        description=__doc__,
+        epilog='Please be responsible.',
+        )
+    completion_group = parser.add_argument_group(
         title='shell completion options',
         )
     completion_group.add_argument(
         '--completion',
-        choices=['bash', 'zsh', 'fish'],
+        choices=_completion_shells,
         help=f"Print {__script__} shell completion to the terminal and exit",
         )
-    completion_args, _ = completion_parser.parse_known_args()
-    parser=argparse.ArgumentParser(
-        prog=__script__,
-        description=__doc__,
-        parents=[completion_parser],
-        epilog='Please be responsible.',
-        )
     parser.add_argument(
         '-v', '--version',
         help='show the version number and exit',
         action='version',
-        version=f'Version: %(prog)s  {__version__}  ({__date__})',
+        version=_version,
         )
-    parser.add_argument(
+    number = parser.add_argument(
         '-n', '--number',
         type=str,
         help=(
             '**Risky option** '
             'Enter selection number or numbers (separated by commas and/or '
-            'using a dash to specify a range) instead of showing the menu.'
+            'using a dash to specify a range) instead of showing the menu. '
+            'Numbers or "quoted" tag names can be combined with `&` '
+            '(in both), `~` (exclude) and parentheses. A dash between two '
+            'numbers is always a range.'
             ),
         )
+    # Dynamic completion of menu numbers, used by shtab (bash, zsh) and
+    # generate_completion.py (fish)
+    number.complete = {
+        'bash': '_mssh_menu_complete_tags',
+        'zsh': '_mssh_menu_complete_tags',
+        'fish': (
+            f"({__script__} --complete-tags "
+            f"(commandline -opc)[2..-1] (commandline -ct))"
+            ),
+        'preamble': {
+            'bash': (
+                '# $1=the -n value being completed\n'
+                '_mssh_menu_complete_tags() {\n'
+                '  compgen -W "$("${COMP_WORDS[0]}" --complete-tags \\\n'
+                '    "${COMP_WORDS[@]:1:COMP_CWORD-1}" "$1" 2>/dev/null \\\n'
+                '    | cut -f1)" -- "$1"\n'
+                '}\n'
+                ),
+            'zsh': (
+                '# Menu numbers and tag names for -n\n'
+                '_mssh_menu_complete_tags() {\n'
+                '  local -a entries\n'
+                '  entries=(${(f)"$(${words[1]} --complete-tags \\\n'
+                '    "${(@Q)words[2,CURRENT-1]}" "${(Q)PREFIX}" \\\n'
+                '    2>/dev/null)"})\n'
+                "  entries=(${entries/$'\\t'/:})\n"
+                "  _describe -t numbers 'menu number' entries\n"
+                '}\n'
+                ),
+            },
+        }
     parser.add_argument(
         '-u', '--user',
         type=str,
@@ -80,33 +177,307 @@ def parse_arguments():
             'Specify an maximum number of menu columns to display.'
             ),
         )
+    parser.add_argument(
+        '-s', '--sort',
+        choices=['csv', 'dns', 'natural'],
+        default='csv',
+        help=(
+            'Order of the ssh sessions. By order in the CSV file (default), '
+            'by DNS name (domain first), or by natural (version) sort.'
+            ),
+        )
     parser.add_argument(
         '-m', '--menu-only',
         action='store_true',
         help='Display the menu selection list and exit.',
         )
+    parser.add_argument(
+        '--page',
+        type=int,
+        default=None,
+        metavar='N',
+        help=(
+            'Show the menu one screen at a time, starting at page N. '
+            'Enter `>` or `<` at the prompt to turn pages.'
+            ),
+        )
+    parser.add_argument(
+        '--filter',
+        action='store_true',
+        help=(
+            'Pick tags from a full screen list narrowed as you type, '
+            'instead of the numbered menu.'
+            ),
+        )
+    parser.add_argument(
+        '--print-hosts',
+        action='store_true',
+        help=(
+            'Print the hosts of the -n selection and exit. '
+            'Does not run tmux or save a user or selection.'
+            ),
+        )
+    parser.add_argument(
+        '-f', '--format',
+        choices=['lines', 'json', 'null'],
+        default='lines',
+        help='Output format of --print-hosts (default=lines).',
+        )
+    parser.add_argument(
+        '-p', '--probe',
+        action='store_true',
+        help=(
+            'Check each host accepts a TCP connection before opening panes. '
+            'Only reachable hosts get a pane.'
+            ),
+        )
+    parser.add_argument(
+        '--probe-port',
+        metavar='PORT',
+        type=int,
+        default=22,
+        help='TCP port used by --probe (default=22).',
+        )
+    parser.add_argument(
+        '--probe-timeout',
+        metavar='SECONDS',
+        type=float,
+        default=3.0,
+        help='Seconds to wait for each host to answer --probe (default=3).',
+        )
+    parser.add_argument(
+        '--probe-limit',
+        metavar='N',
+        type=int,
+        default=64,
+        help='Maximum number of concurrent --probe connections (default=64).',
+        )
+    parser.add_argument(
+        '--exec',
+        dest='command',
+        metavar='CMD',
+        help=(
+            'Run CMD on every selected host over ssh, without tmux. Output '
+            'is printed line by line after the host name, then a summary '
+            'of exit codes and times.'
+            ),
+        )
+    parser.add_argument(
+        '--exec-limit',
+        metavar='N',
+        type=int,
+        default=32,
+        help='Maximum number of concurrent --exec connections (default=32).',
+        )
+    parser.add_argument(
+        '--fail-fast',
+        action='store_true',
+        help='With --exec, stop all hosts once one exits non-zero.',
+        )
+    parser.add_argument(
+        '--resolve',
+        action='store_true',
+        help=(
+            'Look up the addresses of all hosts at once before opening '
+            'panes, so each ssh connects without a DNS query. Addresses are '
+            'cached for --resolve-ttl. Hosts behind a jump host are skipped.'
+            ),
+        )
+    parser.add_argument(
+        '--resolve-limit',
+        metavar='N',
+        type=int,
+        default=16,
+        help='Maximum number of concurrent --resolve lookups (default=16).',
+        )
+    parser.add_argument(
+        '--resolve-ttl',
+        metavar='SECONDS',
+        type=int,
+        default=300,
+        help='Seconds --resolve addresses are cached (default=300).',
+        )
+    parser.add_argument(
+        '--max-panes',
+        metavar='N',
+        type=int,
+        default=None,
+        help=(
+            'Maximum number of panes per tmux window (default=as many as '
+            'fit the terminal). Larger selections are split across several '
+            'synchronized windows in one session.'
+            ),
+        )
+    parser.add_argument(
+        '--broadcast',
+        action='store_true',
+        help=(
+            'Add a broadcast window which sends every keystroke typed in it '
+            'to all windows of the session.'
+            ),
+        )
+    parser.add_argument(
+        '--new-session',
+        action='store_true',
+        help=(
+            'Always start a new tmux session. By default a running session '
+            'for the same user and hosts is attached as is.'
+            ),
+        )
+    parser.add_argument(
+        '--update-session',
+        action='store_true',
+        help=(
+            'If no running session has the same user and hosts, reuse the '
+            'newest one for the same user and CSV file which no terminal is '
+            'attached to, adding and removing panes to match the selected '
+            'hosts.'
+            ),
+        )
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=None,
+        metavar='N',
+        help=(
+            'Start at most N ssh connections per second. Panes open at once '
+            'and each waits its turn before connecting.'
+            ),
+        )
+    parser.add_argument(
+        '--burst',
+        type=int,
+        default=1,
+        metavar='N',
+        help='Connections started at once before --rate applies (default: 1).',
+        )
+    parser.add_argument(
+        '--jitter',
+        type=float,
+        default=0.0,
+        metavar='SECONDS',
+        help='Delay each --rate connection by up to SECONDS more at random.',
+        )
+    parser.add_argument(
+        '--control-persist',
+        default=None,
+        metavar='TIME',
+        help=(
+            'Share one ssh master connection per host (and jump host) '
+            'between panes and later runs, kept open for TIME after the '
+            'last one closes (default=10m, or no with --exec). `no` '
+            'disables sharing.'
+            ),
+        )
+    parser.add_argument(
+        '--log-dir',
+        metavar='DIR',
+        help=(
+            'Log the output of each pane to DIR/SESSION/HOST.log, without '
+            'terminal control sequences. Logs are rotated at --log-max-size '
+            'and older segments are gzipped (HOST.N.log.gz).'
+            ),
+        )
+    parser.add_argument(
+        '--log-max-size',
+        metavar='MB',
+        type=int,
+        default=10,
+        help='Size in MB at which pane logs are rotated (default=10).',
+        )
+    parser.add_argument(
+        '--history-limit',
+        metavar='LINES',
+        type=int,
+        default=None,
+        help=(
+            'Scrollback lines kept by tmux for each new pane. A low limit '
+            'saves tmux memory with many panes; see --log-dir.'
+            ),
+        )
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help=(
+            'Run a daemon which keeps parsed inventories in memory and '
+            'answers menu and selection queries from later runs over a '
+            'Unix socket. Runs in the foreground until interrupted.'
+            ),
+        )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Parse the CSV file without reading or writing the cache.',
+        )
+    parser.add_argument(
+        '--rebuild-cache',
+        action='store_true',
+        help='Parse the CSV file and replace its cached copy.',
+        )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help=(
+            'Print the wall time of each stage, the number of subprocesses '
+            'and the peak memory use on exit.'
+            ),
+        )
+    parser.add_argument(
+        '--profile-trace',
+        metavar='FILE',
+        help='With --profile, also write a Chrome trace event JSON file.',
+        )
+    parser.add_argument(
+        '--profile-dump',
+        metavar='FILE',
+        help='With --profile, also write a cProfile dump (see pstats).',
+        )
     parser.add_argument(
         '-d', '--debug',
         action='store_true',
         #help='Display the items passed to ssh via tmux; do not run it.',
         help=SUPPRESS, # Hidden option to print but not execute commands
         )
+    parser.add_argument(
+        '--complete-tags',
+        metavar='WORD',
+        nargs='*',
+        help=SUPPRESS, # Internal: [WORD ...] TOKEN for shell completion
+        )
+    parser.add_argument(
+        '--relay',
+        metavar='SESSION',
+        help=SUPPRESS, # Internal: runs the --broadcast window
+        )
+    parser.add_argument(
+        '--log-writer',
+        metavar=('DIR', 'SESSION'),
+        nargs=2,
+        help=SUPPRESS, # Internal: writes the --log-dir files of a session
+        )
     parser.add_argument(
         'filename',
         metavar='FILENAME.CSV',
         type=pathlib.Path,
-        default=_csv_default,
-        nargs=OPTIONAL,
-        help=f'name of CSV file (default=$HOME/servers.csv)',
+        default=[pathlib.Path(_csv_default)],
+        nargs=ZERO_OR_MORE,
+        help=(
+            'names of CSV files, glob patterns or directories of CSV files '
+            '(default=$HOME/servers.csv)'
+            ),
         )
     return parser
 
 
 def read_jsonfile(f=_jsoncache):
-    """Takes a pathlib file path. Creates and returns a default json obj"""
-    if (j := f).exists():
-        jsonobj = json.loads(j.read_text())
-    else:
+    """Takes a file path. Creates and returns a default json obj"""
+    import json
+    import pathlib
+    try:
+        jsonobj = json.loads(pathlib.Path(f).read_text())
+    except (OSError, ValueError):
+        jsonobj = {}
+    if not isinstance(jsonobj, dict):
         jsonobj = {}
     if not csvfile in jsonobj:
         jsonobj[csvfile] = {'user': '', 'last_selection': ''}
@@ -114,12 +485,61 @@ def read_jsonfile(f=_jsoncache):
 
 
 def write_jsonfile(jsonobj,f=_jsoncache):
-    """Takes a jsonobj and a pathlib file path. Writes jsonobj to file.
-    Returns the number of bytes written.
+    """Takes a jsonobj and a file path. Writes jsonobj to a temporary file
+    and renames it over the file. Returns the number of bytes written.
     """
-    numbytes = f.write_text(
-        json.dumps(jsonobj, indent=1),
+    import json
+    import pathlib
+    f = pathlib.Path(f)
+    tmp = f.with_name(f'.{f.name}.{os.getpid()}')
+    numbytes = tmp.write_text(
+        json.dumps(jsonobj, separators=(',', ':')),
         )
+    os.replace(tmp, f)
+    return numbytes
+
+
+def read_state():
+    """Returns the saved state of the csv file. The state file is read
+    once per process and the changes are written once at exit
+    """
+    global _state
+    if _state is None:
+        import atexit
+        _state = read_jsonfile()
+        atexit.register(write_state)
+    return _state[csvfile]
+
+
+def update_state(**changes):
+    """Updates the saved state of the csv file, e.g. user='name'"""
+    read_state().update(changes)
+    _state_changes.update(changes)
+
+
+def write_state(f=_jsoncache, max_entries=None):
+    """Merges this run's changes into the state file while holding a lock
+    so concurrent runs don't lose each other's changes. Keeps only the
+    most recently used csv files. Returns the number of bytes written.
+    """
+    import fcntl
+    import time
+    if not _state_changes:
+        return 0
+    max_entries = max_entries or _state_max_entries
+    with open(f'{f}.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        jsonobj = read_jsonfile(f)
+        jsonobj[csvfile].update(_state_changes, last_used=time.time())
+        if len(jsonobj) > max_entries:
+            lru = sorted(
+                jsonobj,
+                key=lambda k: jsonobj[k].get('last_used', 0),
+                reverse=True,
+                )
+            jsonobj = {k: jsonobj[k] for k in lru[:max_entries]}
+        numbytes = write_jsonfile(jsonobj, f)
+    _state_changes.clear()
     return numbytes
 
 
@@ -130,81 +550,811 @@ def sortbydns(host):
     return sort
 
 
-def sortbycsv(host, csvlist):
-    """Function which can be used as a key in sort to sort by order in csv"""
-    sort = [item for item, *_ in csvlist].index(host)
-    return sort
+def natural_key(text):
+    """Function which can be used as a key in sort to sort naturally.
+    Text and numbers alternate in the key, starting and ending with text
+    """
+    import itertools
+    key = ['']
+    for digits, group in itertools.groupby(text, '0123456789'.__contains__):
+        if digits:
+            key += [int(''.join(group)), '']
+        else:
+            key[-1] = ''.join(group).lower()
+    return key
 
 
 def natural_sort(somelist):
     """Takes a list of strings and sorts them in a natural human format
     also known as version sorting i.e. Number10 after Number1 and Number 2
     """
-    l = somelist
-    convert = lambda text: int(text) if text.isdigit() else text.lower()
-    alphanum_key = lambda key: [convert(c) for c in re.split(r'([0-9]+)',key)]
-    return sorted(l, key=alphanum_key)
+    return sorted(somelist, key=natural_key)
+
+
+def sort_hosts(hosts, sort='csv'):
+    """Takes a list of hosts in csv order and a sort method.
+    Returns the hosts sorted. Ties keep the order in the csv
+    """
+    if sort == 'dns':
+        return sorted(hosts, key=sortbydns)
+    elif sort == 'natural':
+        return sorted(hosts, key=natural_key)
+    return list(hosts)
+
+
+def iter_csv(csv_filename, options=None):
+    """Reads the CSV file and yields one cleaned up row at a time.
+    Typed columns named in the header (see _host_columns) are not tags;
+    their values are added to the options dictionary of host to ssh
+    options when given. The first value seen for a host is kept
+    """
+    import csv
+    with csv_filename.open() as f:
+        reader = csv.reader(f)
+        # Skip empty lines and the header
+        header = []
+        for line in reader:
+            if line:
+                header = line
+                break
+        typed = {}
+        for n, name in enumerate(header[1:], 1):
+            name = ''.join(filter(str.isalnum, name.lower()))
+            if name in _host_columns:
+                typed[n] = _host_columns[name]
+        for host, *tags in filter(None, reader):
+            if not host: #checks for no host but tag exist
+                continue
+            host = host.strip()
+            if typed:
+                values = {}
+                for n, tag in enumerate(tags, 1):
+                    if n in typed and (value := tag.strip()):
+                        values[typed[n]] = value
+                tags = [tag for n, tag in enumerate(tags, 1) if n not in typed]
+                if values:
+                    values = host_options(host, values)
+                    if options is not None:
+                        hostoptions = options.setdefault(host, {})
+                        for key, value in values.items():
+                            hostoptions.setdefault(key, value)
+            # Clean up the row, remove whitespace & empties. Default tag
+            tags = [tag.strip() for tag in tags if tag] or ['No Tag']
+            yield (host, *tags)
+
+
+def host_options(host, values):
+    """Takes a host and its typed csv column values by ssh option name.
+    Returns them converted. Raises ValueError if not valid
+    """
+    if 'Port' in values:
+        port = values['Port']
+        if not (port.isdigit() and 0 < int(port) < 65536):
+            raise ValueError(f'Invalid port `{port}` for host `{host}`')
+        values['Port'] = int(port)
+    return values
 
 
 def open_csv(csv_filename):
     "Reads the CSV file and returns a list"
-    # Open the csv file, remove empty lines and remove the header
-    with csv_filename.open() as f:
-        csvlist = [line for line in csv.reader(f) if line]
-        _ = csvlist.pop(0)
-    # Clean up the csvlist, remove whitespace & empties. Default tag if none
-    csvlist = [
-        (host.strip(), *([tag.strip() for tag in tags if tag] or ['No Tag']))
-        for host, *tags in csvlist if host #checks for no host but tag exist
-            ]
-    return csvlist
+    return list(iter_csv(csv_filename))
+
+
+def build_tag_index(rows):
+    """Single pass over an iterable of csv rows. Returns a list of unique
+    hosts in csv order and an inverted index of tag to host ids. Host ids
+    are positions in the hosts list, stored sorted in an array
+    """
+    import array
+    hosts = []
+    hostids = {}
+    tagsdict = {}
+    unsorted = set()
+    intern = sys.intern
+    for host, *tags in rows:
+        if (hostid := hostids.get(host)) is None:
+            hostid = hostids[host] = len(hosts)
+            hosts.append(intern(host))
+        for tag in tags:
+            if (ids := tagsdict.get(tag)) is None:
+                ids = tagsdict[intern(tag)] = array.array('I')
+            elif ids[-1] >= hostid:
+                # A host repeated on a later row; fixed up at the end
+                if ids[-1] == hostid:
+                    continue
+                unsorted.add(tag)
+            ids.append(hostid)
+    for tag in unsorted:
+        tagsdict[tag] = array.array('I', sorted(set(tagsdict[tag])))
+    return hosts, tagsdict
+
+
+def resolve_selection(selection, tagslist, tagsdict, hosts):
+    """Takes a list of menu numbers and the host id index.
+    Returns the list of selected hosts in csv order
+    """
+    ids = set().union(*(tagsdict[tagslist[int(n)-1]] for n in selection))
+    return [hosts[i] for i in sorted(ids)]
+
+
+def file_digest(f):
+    """Takes a pathlib file path. Returns the sha256 hex digest"""
+    import hashlib
+    h = hashlib.sha256()
+    with f.open('rb') as fb:
+        while (chunk := fb.read(1 << 20)):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_name(csv_filename):
+    """Takes a csv file path. Returns the name its cache files share"""
+    import hashlib
+    path = os.path.realpath(csv_filename)
+    return hashlib.sha1(path.encode()).hexdigest()
+
+
+def cache_path(csv_filename, d=_pklcache):
+    """Takes a csv file path. Returns the path of its inventory cache"""
+    import pathlib
+    return pathlib.Path(d) / f'{cache_name(csv_filename)}.pickle'
+
+
+def read_inventory_cache(csv_filename, f=None):
+    """Returns the cached inventory for the csv file or None when missing
+    or stale. Checked by mtime and size, then by content hash
+    """
+    import pickle
+    f = f or cache_path(csv_filename)
+    try:
+        cache = pickle.loads(f.read_bytes())
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    stat = csv_filename.stat()
+    if (not isinstance(cache, dict) or cache.get('version') != __version__
+            or cache.get('format') != _cache_format
+            or cache.get('size') != stat.st_size):
+        return None
+    if cache['mtime_ns'] != stat.st_mtime_ns:
+        # Touched but maybe not modified; compare contents instead
+        if cache['sha256'] != file_digest(csv_filename):
+            return None
+        cache['mtime_ns'] = stat.st_mtime_ns
+        write_inventory_cache(cache, f)
+    return cache['inventory']
+
+
+def write_inventory_cache(cache, f):
+    """Takes a cache dict and a pathlib file path. Writes it atomically.
+    Returns the number of bytes written.
+    """
+    import pickle
+    f.parent.mkdir(parents=True, exist_ok=True)
+    tmp = f.with_name(f'.{f.name}.{os.getpid()}')
+    numbytes = tmp.write_bytes(
+        pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+    os.replace(tmp, f)
+    return numbytes
+
+
+def parse_inventory(csv_filename):
+    """Streams the csv file into the tag index. Returns a tuple of hosts,
+    tagslist, tagsdict (tag to array of host ids) and options (host to
+    ssh options from typed columns). Raises ValueError if not valid
+    """
+    options = {}
+    hosts, tagsdict = build_tag_index(iter_csv(csv_filename, options))
+    tagslist = natural_sort(tagsdict)
+    return hosts, tagslist, tagsdict, options
+
+
+def tags_index_path(csv_filename, d=_pklcache):
+    """Takes a csv file path. Returns the path of its tag names sidecar"""
+    return os.path.join(d, f'{cache_name(csv_filename)}.tags')
+
+
+def write_tags_index(csv_filename, tagslist):
+    """Writes the menu tag names of the csv file to a plain text sidecar.
+    The first line holds the csv mtime and size it was built from.
+    Returns the number of bytes written.
+    """
+    f = tags_index_path(csv_filename)
+    stat = os.stat(csv_filename)
+    lines = [f'{stat.st_mtime_ns} {stat.st_size}']
+    lines.extend(' '.join(tag.splitlines()) for tag in tagslist)
+    d, name = os.path.split(f)
+    tmp = os.path.join(d, f'.{name}.{os.getpid()}')
+    with open(tmp, 'w') as fw:
+        numbytes = fw.write('\n'.join(lines) + '\n')
+    os.replace(tmp, f)
+    return numbytes
+
+
+def read_tags_index(csv_filename):
+    """Returns the menu tag names of the csv file from its sidecar or None
+    when the sidecar is missing or older than the csv file
+    """
+    try:
+        with open(tags_index_path(csv_filename)) as f:
+            stamp, *tagslist = f.read().splitlines()
+        stat = os.stat(csv_filename)
+    except (OSError, ValueError):
+        return None
+    if stamp != f'{stat.st_mtime_ns} {stat.st_size}':
+        return None
+    return tagslist
+
+
+def complete_tags(words):
+    """Prints the menu numbers and tag names for shell completion.
+    Takes the words of the command line after the program name, the last
+    being TOKEN, the `-n` value being completed. The menu is the one of
+    the FILENAME.CSV words among them, as in a run. Numbers already typed
+    before a comma are kept
+    """
+    token = words.pop() if words and not words[-1].endswith('.csv') else ''
+    if words[-1:] in (['-n'], ['--number']):
+        words.pop()
+    try:
+        paths = inventory_paths(command_line_filenames(words))
+    except FileNotFoundError:
+        return
+    if not (tagslist := completion_tagslist(paths)):
+        return
+    head = token[:token.rfind(',') + 1]
+    print('\n'.join(
+        f'{head}{n}\t{tag}' for n, tag in enumerate(tagslist, 1)
+        ))
+
+
+def command_line_filenames(words):
+    """Takes the words of a command line after the program name. Returns
+    its FILENAME.CSV words, the words which are neither options nor the
+    values of options in _value_options, else the default csv file
+    """
+    names = []
+    words = iter(words)
+    for word in words:
+        if word == '--':
+            names.extend(words)
+        elif word.startswith('--'):
+            if word in _value_options:
+                next(words, None)
+        elif word.startswith('-') and len(word) > 1:
+            # Short options, the last may take the next word as its value
+            for i, c in enumerate(word[1:], 2):
+                if f'-{c}' in _value_options:
+                    if i == len(word):
+                        next(words, None)
+                    break
+        else:
+            names.append(word)
+    return names or [_csv_default]
+
+
+def completion_tagslist(paths):
+    """Returns the menu tag names of the csv files, from their sidecars,
+    else the daemon, else their inventories. Files which fail to load are
+    left out, as in a run
+    """
+    tagslists = [read_tags_index(path) for path in paths]
+    if None in tagslists:
+        files = [os.path.realpath(path) for path in paths]
+        if (reply := daemon_request({'op': 'menu', 'files': files})):
+            return reply.get('tagslist')
+        import csv
+        import pathlib
+        for i, path in enumerate(paths):
+            if tagslists[i] is None:
+                try:
+                    tagslists[i] = load_inventory(pathlib.Path(path))[1]
+                except (OSError, ValueError, csv.Error):
+                    tagslists[i] = []
+    if len(tagslists) == 1:
+        return tagslists[0]
+    # The merged menu of several files, see merge_inventories
+    return natural_sort(set().union(*tagslists))
+
+
+def cached_inventory(csv_filename, f=None):
+    """Returns the cached inventory of the csv file, or None when missing
+    or stale. Writes the tag names sidecar if it is missing
+    """
+    if (inventory := read_inventory_cache(csv_filename, f)):
+        if not os.path.exists(tags_index_path(csv_filename)):
+            write_tags_index(csv_filename, inventory[1])
+    return inventory
+
+
+def load_inventory(csv_filename, use_cache=True, rebuild=False):
+    """Returns the parsed inventory of the csv file. Reads it from the
+    cache when the csv file is unchanged, else parses and caches it
+    """
+    if not use_cache:
+        return parse_inventory(csv_filename)
+    f = cache_path(csv_filename)
+    if not rebuild and (inventory := cached_inventory(csv_filename, f)):
+        return inventory
+    stat = csv_filename.stat()
+    inventory = parse_inventory(csv_filename)
+    cache = {
+        'version': __version__,
+        'format': _cache_format,
+        'path': str(csv_filename.resolve()),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': file_digest(csv_filename),
+        'inventory': inventory,
+        }
+    try:
+        write_inventory_cache(cache, f)
+        write_tags_index(csv_filename, inventory[1])
+    except OSError as e:
+        print(
+            f'Warning: could not write inventory cache: {e}',
+            file=sys.stderr,
+            )
+    return inventory
+
+
+def inventory_paths(names):
+    """Takes csv file names, glob patterns or directories (of *.csv files).
+    Returns the csv file names in order, each once. Raises
+    FileNotFoundError for a name which matches nothing
+    """
+    paths = {}
+    for name in map(str, names):
+        name = os.path.expanduser(name)
+        if os.path.exists(name) and not os.path.isdir(name):
+            found = [name]
+        else:
+            # Only for directories and patterns, glob is slow to import
+            import glob
+            pattern = name
+            if os.path.isdir(name):
+                pattern = os.path.join(glob.escape(name), '*.csv')
+            found = sorted(glob.glob(pattern), key=natural_key)
+        if not found:
+            raise FileNotFoundError(name)
+        for f in found:
+            paths.setdefault(os.path.realpath(f), f)
+    return list(paths.values())
+
+
+def merge_inventories(inventories):
+    """Takes parsed inventories (hosts, tagslist, tagsdict, options) in
+    file order. Returns one inventory, hosts in file then row order as if
+    the files were one csv file
+    """
+    import array
+    if len(inventories) == 1:
+        return inventories[0]
+    hosts = []
+    hostids = {}
+    tagsdict = {}
+    options = {}
+    unsorted = set()
+    for fhosts, _, ftagsdict, foptions in inventories:
+        remap = array.array('I')
+        fresh = True
+        for host in fhosts:
+            if (hostid := hostids.get(host)) is None:
+                hostid = hostids[host] = len(hosts)
+                hosts.append(host)
+            else:
+                fresh = False
+            remap.append(hostid)
+        for tag, ids in ftagsdict.items():
+            ids = array.array('I', map(remap.__getitem__, ids))
+            if (merged := tagsdict.get(tag)) is None:
+                tagsdict[tag] = ids
+            else:
+                if ids[0] <= merged[-1]:
+                    unsorted.add(tag)
+                merged.extend(ids)
+            if not fresh:
+                # Hosts seen in an earlier file keep their earlier ids
+                unsorted.add(tag)
+        for host, hostoptions in foptions.items():
+            merged = options.setdefault(host, {})
+            for key, value in hostoptions.items():
+                merged.setdefault(key, value)
+    for tag in unsorted:
+        tagsdict[tag] = array.array('I', sorted(set(tagsdict[tag])))
+    return hosts, natural_sort(tagsdict), tagsdict, options
 
 
-def get_tags_from_csv(csvlist):
-    "Returns a list of tags (tagslist) and a dictionary of tags (tagsdict)"
-    # list of unique tags, (remove host and flatten the list, convert to set)
-    tagslist = natural_sort(set([
-        tag for tags in [rtags for host,*rtags in csvlist] for tag in tags
-            ]))
-    # initialize dictionary; keys are tag names; values are empty sets
-    tagsdict = {tag: set() for tag in tagslist}
-    # for each line, add the host to the tag key list if it contains the tag
-    for host, *tags in csvlist:
-        for tag in tagsdict:
-            if tag in tags:
-                tagsdict[tag].add(host)
-    return tagslist, tagsdict
+class Inventory:
+    """The hosts and tags of a csv file. Resolves menu selections to hosts
+    without the menu, tmux or the state file, e.g.
+
+        inventory = Inventory.from_csv('servers.csv')
+        hosts = inventory.resolve('1,3-5')
+    """
+
+    def __init__(self, hosts, tagslist, tagsdict, options=None):
+        self.hosts = hosts
+        self.tagslist = tagslist
+        self.tagsdict = tagsdict
+        self.options = options or {}
+        self.bitsets = {}
+
+    @classmethod
+    def from_csv(cls, csv_filename, use_cache=True, rebuild=False):
+        """Returns the inventory of the csv file. An inventory already
+        loaded by this process is reused while the file is unchanged.
+        Raises ValueError if a typed column value is not valid
+        """
+        import pathlib
+        csv_filename = pathlib.Path(csv_filename)
+        stat = csv_filename.stat()
+        path = os.path.realpath(csv_filename)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if use_cache and not rebuild and path in _inventories:
+            if (loaded := _inventories[path])[0] == stamp:
+                return loaded[1]
+        inventory = cls(*load_inventory(csv_filename, use_cache, rebuild))
+        if use_cache:
+            _inventories[path] = (stamp, inventory)
+        return inventory
+
+    @classmethod
+    def from_files(cls, paths, use_cache=True, rebuild=False, errors=None):
+        """Returns the merged inventory of several csv files, hosts in file
+        then row order. Files not in the cache are parsed in a process
+        pool when large enough. A file which fails to load is added to
+        the errors list as (path, exception) and skipped if a list is
+        given, else the exception is raised
+        """
+        import csv
+        if len(paths) == 1 and errors is None:
+            return cls.from_csv(paths[0], use_cache, rebuild)
+        failures = (OSError, ValueError, csv.Error)
+        loaded = {}
+        misses = []
+        for path in paths:
+            if use_cache and not rebuild:
+                try:
+                    if (inventory := cached_inventory(path)):
+                        loaded[path] = inventory
+                        continue
+                except failures:
+                    pass
+            misses.append(path)
+        size = sum(os.path.getsize(p) for p in misses if os.path.isfile(p))
+        workers = min(len(misses), os.cpu_count() or 1)
+        if workers > 1 and size >= _parallel_min_bytes:
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                futures = {
+                    path: executor.submit(
+                        load_inventory, path, use_cache, rebuild,
+                        )
+                    for path in misses
+                    }
+                for path, future in futures.items():
+                    try:
+                        loaded[path] = future.result()
+                    except failures as e:
+                        if errors is None:
+                            raise
+                        errors.append((path, e))
+        else:
+            for path in misses:
+                try:
+                    loaded[path] = load_inventory(path, use_cache, rebuild)
+                except failures as e:
+                    if errors is None:
+                        raise
+                    errors.append((path, e))
+        return cls(*merge_inventories(
+            [loaded[path] for path in paths if path in loaded]
+            ))
+
+    def numbers(self, selection):
+        """Takes a selection string (e.g. '1,3-5') or menu numbers.
+        Returns the list of menu numbers. Raises ValueError if not valid
+        """
+        if isinstance(selection, str):
+            return selection_numbers(selection, len(self.tagslist))
+        numbers = [int(n) for n in selection]
+        if not all(0 < n <= len(self.tagslist) for n in numbers):
+            raise ValueError(f'Invalid input: `{selection}`')
+        return numbers
+
+    def resolve(self, selection):
+        """Takes a selection expression (e.g. '1,3-5' or
+        '"Site 2" & Primary') or menu numbers. Returns the selected hosts
+        in csv order
+        """
+        if isinstance(selection, str):
+            ids = bitset_to_ids(self.evaluate(selection))
+            return [self.hosts[i] for i in ids]
+        numbers = self.numbers(selection)
+        return resolve_selection(
+            numbers, self.tagslist, self.tagsdict, self.hosts,
+            )
+
+    def bitset(self, tags):
+        """Takes a tuple of tags. Returns an int bitset of their hosts.
+        Single tag bitsets are kept for later queries
+        """
+        if len(tags) != 1:
+            import itertools
+            ids = itertools.chain.from_iterable(map(self.tagsdict.get, tags))
+            return ids_to_bitset(ids, len(self.hosts))
+        tag, = tags
+        if (bitset := self.bitsets.get(tag)) is None:
+            bitset = ids_to_bitset(self.tagsdict[tag], len(self.hosts))
+            self.bitsets[tag] = bitset
+        return bitset
+
+    def evaluate(self, selection):
+        """Takes a selection expression. Returns the selected hosts as an
+        int bitset, bit n set for self.hosts[n]. Raises ValueError
+        """
+        stack = []
+        operations = selection_operands(
+            selection, self.tagslist, self.tagsdict,
+            )
+        for kind, tags in operations:
+            if kind == 'tags':
+                stack.append(self.bitset(tags))
+                continue
+            right = stack.pop()
+            left = stack.pop()
+            if kind == '|':
+                stack.append(left | right)
+            elif kind == '&':
+                stack.append(left & right)
+            else:
+                stack.append(left & ~right)
+        return stack.pop()
+
+    def query(self, *tags):
+        """Takes tag names. Returns the hosts with any of the tags in csv
+        order. Raises KeyError for an unknown tag
+        """
+        ids = set().union(*(self.tagsdict[tag] for tag in tags))
+        return [self.hosts[i] for i in sorted(ids)]
+
+
+class RemoteInventory:
+    """An inventory kept by the --serve daemon. Has the tagslist, options
+    and resolve of Inventory. Loads the files in-process instead if the
+    daemon stops answering
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.options = {}
+        self.local = None
+        self._tagslist = None
+
+    @classmethod
+    def connect(cls, paths, errors=None):
+        """Returns the daemon's inventory of the csv files, or None when no
+        daemon answers or it cannot load them. Files it skipped are added
+        to errors as (path, message)
+        """
+        files = [os.path.realpath(f) for f in paths]
+        reply = daemon_request({'op': 'load', 'files': files})
+        if not reply or 'error' in reply:
+            return None
+        if errors is not None:
+            errors.extend(map(tuple, reply['errors']))
+        return cls(files)
+
+    def load_locally(self):
+        """Returns the inventory loaded in this process"""
+        import pathlib
+        if self.local is None:
+            self.local = Inventory.from_files(
+                [pathlib.Path(f) for f in self.files], errors=[],
+                )
+            self.options = self.local.options
+        return self.local
+
+    @property
+    def tagslist(self):
+        if self._tagslist is None:
+            reply = None
+            if self.local is None:
+                reply = daemon_request({'op': 'menu', 'files': self.files})
+            if reply and 'tagslist' in reply:
+                self._tagslist = reply['tagslist']
+            else:
+                self._tagslist = self.load_locally().tagslist
+        return self._tagslist
+
+    def resolve(self, selection):
+        """Takes a selection expression or menu numbers. Returns the
+        selected hosts in csv order. Raises ValueError if not valid
+        """
+        reply = None
+        if self.local is None:
+            reply = daemon_request({
+                'op': 'resolve', 'files': self.files, 'selection': selection,
+                })
+        if reply and 'hosts' in reply:
+            self.options.update(reply['options'])
+            return reply['hosts']
+        if reply and reply.get('invalid'):
+            raise ValueError(reply['error'])
+        return self.load_locally().resolve(selection)
+
+
+def daemon_request(request, path=_socket, timeout=5.0):
+    """Sends a request to the --serve daemon. Returns its reply, or None
+    when no daemon of this version answers
+    """
+    if not os.path.exists(path):
+        return None
+    import json
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            with sock.makefile('rb') as f:
+                reply = json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(reply, dict) or reply.get('version') != __version__:
+        return None
+    return reply
+
+
+def served_inventory(files):
+    """Returns the inventory of the csv files and the files skipped as
+    (path, message), parsed again only when a file's mtime or size changed
+    """
+    import pathlib
+    stamps = [(s.st_mtime_ns, s.st_size) for s in map(os.stat, files)]
+    key = tuple(files)
+    if (entry := _served.get(key)) and entry[0] == stamps:
+        return entry[1], entry[2]
+    errors = [] if len(files) > 1 else None
+    inventory = Inventory.from_files(
+        [pathlib.Path(f) for f in files], errors=errors,
+        )
+    errors = [(str(f), str(e)) for f, e in errors or []]
+    _served[key] = (stamps, inventory, errors)
+    return inventory, errors
+
+
+def serve_request(request):
+    """Answers one daemon request (a dictionary). Returns the reply"""
+    op = request.get('op')
+    if op == 'ping':
+        return {}
+    inventory, errors = served_inventory(request['files'])
+    if op == 'load':
+        return {'errors': errors}
+    elif op == 'menu':
+        return {'tagslist': inventory.tagslist}
+    elif op == 'resolve':
+        try:
+            hosts = inventory.resolve(request['selection'])
+        except ValueError as e:
+            return {'error': str(e), 'invalid': True}
+        options = inventory.options
+        return {
+            'hosts': hosts,
+            'options': {h: options[h] for h in hosts if h in options},
+            }
+    return {'error': f'Unknown request `{op}`'}
+
+
+def serve(path=_socket):
+    """Runs the inventory daemon on a Unix socket until interrupted.
+    Requests and replies are one line of JSON each
+    """
+    import json
+    import signal
+    import socketserver
+    import threading
+    if daemon_request({'op': 'ping'}, path) is not None:
+        print(f'[ERROR]: A daemon is already serving on {path}. Bye.')
+        sys.exit(1)
+    if os.path.exists(path):
+        os.unlink(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lock = threading.Lock()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+                with lock:
+                    reply = serve_request(request)
+            except Exception as e:
+                # Report the error to the client and keep serving
+                reply = {'error': f'{type(e).__name__}: {e}'}
+            reply['version'] = __version__
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    os.chmod(path, 0o600)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+    print(f'Serving inventories on {path}. Press Ctrl-C to stop.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def print_hosts(hosts, fmt='lines'):
+    """Prints hosts for other programs: one per line, a json list or
+    null terminated (for xargs -0)
+    """
+    if fmt == 'json':
+        import json
+        print(json.dumps(hosts))
+    elif fmt == 'null':
+        sys.stdout.write(''.join(f'{host}\0' for host in hosts))
+    elif hosts:
+        print('\n'.join(hosts))
 
 
 def horizontal_table(items, columns=1, sep='  '):
     """Takes a list. Returns a list of list per number columns given"""
+    import math
     rows = math.ceil(len(items) / max(columns, 1))
     table = [items[(i*rows):(i*rows+rows)] for i in range(columns)]
     table = [g for g in table if g]
     return table[:-1] + [[item.removesuffix(sep) for item in table[-1]]]
 
 
-def vertical_table(items, pad_lines=0, sep='  '):
+def vertical_table(items, pad_lines=0, sep='  ', lines=None):
     """Takes a list. Returns a list of list per number lines available"""
-    lines = max(shutil.get_terminal_size().lines - max(pad_lines, 0), 1)
+    import math
+    import shutil
+    lines = lines or shutil.get_terminal_size().lines
+    lines = max(lines - max(pad_lines, 0), 1)
     columns = math.ceil(len(items) / lines)
     table = [items[(i*lines):(i*lines+lines)] for i in range(columns)]
     table = [g for g in table if g]
     return table[:-1] + [[item.removesuffix(sep) for item in table[-1]]]
 
 
-def do_items_fit(table):
+def do_items_fit(table, width=None):
     """Takes a list of list. Determines if items will fit the term size"""
+    import shutil
     widths = tuple(len(max(items, key=len)) for items in table)
-    return sum(widths) <= shutil.get_terminal_size().columns
+    return sum(widths) <= (width or shutil.get_terminal_size().columns)
 
 
-def optimal_number_of_columns(items, sep='  '):
-    """Determines the maximum amount of columns that will fit on screen"""
-    for n, _ in enumerate(items, 2):
-        table = horizontal_table(items, n, sep)
-        if not do_items_fit(table):
+def optimal_number_of_columns(items, sep='  ', width=None):
+    """Determines the maximum amount of columns that will fit on screen.
+    Item widths are measured once; each column count is then checked
+    without building the table, stopping once the width is exceeded
+    """
+    import math
+    import shutil
+    width = width or shutil.get_terminal_size().columns
+    total_items = len(items)
+    lengths = list(map(len, items))
+    # The last column has the separator removed from its items
+    seps = [sep] * total_items
+    lastlengths = list(map(len, map(str.removesuffix, items, seps)))
+    for n in range(2, total_items + 2):
+        rows = math.ceil(total_items / n)
+        last = (math.ceil(total_items / rows) - 1) * rows
+        total = max(lastlengths[last:])
+        for start in range(0, last, rows):
+            if total > width:
+                break
+            total += max(lengths[start:start+rows])
+        if total > width:
             return n-1
+    return total_items + 1
 
 
 def format_items(items, sep='  '):
@@ -213,26 +1363,212 @@ def format_items(items, sep='  '):
     return [f"{n: >{d}}. {item}{sep}" for n, item in enumerate(items, 1)]
 
 
-def format_table(table):
-    """Takes a list of list. Returns a list of the text to print per line"""
-    lengths = [len(row) for row in table]
-    widths = tuple(len(max(items, key=len)) for items in table)
-    table[-1].extend([''] * (max(lengths) - lengths[-1]))
-    transposed_table = [list(row) for row in zip(*table)]
-    tmp_table1 = [list(zip(row, widths)) for row in transposed_table]
-    return [''.join([f"{i: <{w}}" for i, w in row]) for row in tmp_table1]
+def format_table(table):
+    """Takes a list of list. Returns a list of the text to print per line"""
+    lengths = [len(row) for row in table]
+    widths = tuple(len(max(items, key=len)) for items in table)
+    table[-1].extend([''] * (max(lengths) - lengths[-1]))
+    transposed_table = [list(row) for row in zip(*table)]
+    tmp_table1 = [list(zip(row, widths)) for row in transposed_table]
+    return [''.join([f"{i: <{w}}" for i, w in row]) for row in tmp_table1]
+
+
+def make_table(items, columns=None, pad_lines=2, sep='  '):
+    """Takes a list. Returns a list which will print neatly to the screen"""
+    import shutil
+    if columns:
+        table = horizontal_table(items, columns, sep)
+    else:
+        size = shutil.get_terminal_size()
+        table = vertical_table(items, pad_lines, sep, size.lines)
+        if not do_items_fit(table, size.columns):
+            columns = optimal_number_of_columns(items, sep, size.columns)
+            table = horizontal_table(items, columns, sep)
+    return format_table(table)
+
+
+class MenuPager:
+    """Lays out the numbered menu one screen at a time. Only the item
+    widths are kept for the whole list; each page is formatted when shown
+    """
+
+    def __init__(self, tagslist, columns=None, pad_lines=0, sep='  '):
+        import array
+        import shutil
+        size = shutil.get_terminal_size()
+        self.tagslist = tagslist
+        self.sep = sep
+        self.lines = max(size.lines - max(pad_lines, 0), 1)
+        self.digits = len(str(len(tagslist)))
+        extra = self.digits + len('. ') + len(sep)
+        self.widths = array.array('I', (len(t) + extra for t in tagslist))
+        # The first item and the column widths of each page
+        self.pages = []
+        start = 0
+        while start < len(tagslist):
+            widths = self.page_columns(start, size.columns, columns)
+            self.pages.append((start, widths))
+            start += len(widths) * self.lines
+
+    def page_columns(self, start, width, columns=None):
+        """Returns the widths of the columns fitting a page from start"""
+        widths = []
+        used = 0
+        for first in range(start, len(self.widths), self.lines):
+            w = max(self.widths[first:first+self.lines])
+            # The last column has the separator removed from its items
+            if widths and (
+                    used + w - len(self.sep) > width
+                    or len(widths) == columns):
+                break
+            widths.append(w)
+            used += w
+        return widths
+
+    def page_lines(self, page):
+        """Yields the text to print per line of a page"""
+        start, widths = self.pages[page]
+        stop = min(start + len(widths) * self.lines, len(self.tagslist))
+        d = self.digits
+        for row in range(start, min(start + self.lines, stop)):
+            yield ''.join(
+                f'{n+1: >{d}}. {self.tagslist[n]}{self.sep}'.ljust(w)
+                for n, w in zip(range(row, stop, self.lines), widths)
+                ).rstrip()
+
+    def print_page(self, page):
+        """Streams a page to stdout"""
+        for line in self.page_lines(page):
+            print(line)
+
+
+def build_trigram_index(folded):
+    """Takes a list of casefolded tags. Returns a dictionary of each three
+    character substring to the ascending positions of the tags with it
+    """
+    trigrams = {}
+    for n, tag in enumerate(folded):
+        for trigram in {tag[i:i+3] for i in range(len(tag) - 2)}:
+            trigrams.setdefault(trigram, []).append(n)
+    return trigrams
+
+
+def filter_tags(query, folded, trigrams=None, candidates=None):
+    """Returns the positions of the tags containing every space separated
+    term of the query. Checks only the candidates when given (e.g. the
+    result for a shorter query), or the trigram index posting list of the
+    longest term when that is shorter
+    """
+    terms = query.casefold().split()
+    if candidates is None:
+        candidates = range(len(folded))
+    longest = max(terms, key=len, default='')
+    if trigrams and len(longest) >= 3:
+        postings = min((
+            trigrams.get(longest[i:i+3], ())
+            for i in range(len(longest) - 2)
+            ), key=len)
+        if len(postings) < len(candidates):
+            candidates = postings
+    for term in terms:
+        candidates = [n for n in candidates if term in folded[n]]
+    return list(candidates)
+
+
+def numbers_to_selection(numbers):
+    """Takes menu numbers. Returns a selection string using ranges"""
+    numbers = sorted(set(numbers))
+    runs = []
+    for n in numbers:
+        if runs and runs[-1][1] == n - 1:
+            runs[-1][1] = n
+        else:
+            runs.append([n, n])
+    return ','.join(f'{a}-{b}' if a != b else f'{a}' for a, b in runs)
 
 
-def make_table(items, columns=None, pad_lines=2, sep='  '):
-    """Takes a list. Returns a list which will print neatly to the screen"""
-    if columns:
-        table = horizontal_table(items, columns, sep)
-    else:
-        table = vertical_table(items, pad_lines, sep)
-        if not do_items_fit(table):
-            columns = optimal_number_of_columns(items, sep)
-            table = horizontal_table(items, columns, sep)
-    return format_table(table)
+def filter_menu(tagslist):
+    """Full screen tag picker. Typing narrows the list from the previous
+    result, only the visible page is drawn. Tab marks a tag, Ctrl-A marks
+    every match and Enter returns the marked (or highlighted) menu
+    numbers. Esc returns None
+    """
+    import curses
+    import threading
+    folded = [tag.casefold() for tag in tagslist]
+    # Narrowing alone keeps keystrokes fast; the index, built while the
+    # user types, cuts the first three character queries on big lists
+    index = []
+    threading.Thread(
+        target=lambda: index.append(build_trigram_index(folded)),
+        daemon=True,
+        ).start()
+    d = len(str(len(tagslist)))
+
+    def picker(screen):
+        curses.curs_set(0)
+        # One (query, result) per typed character; backspace pops
+        stack = [('', list(range(len(tagslist))))]
+        marked = set()
+        cursor = 0
+        while True:
+            query, results = stack[-1]
+            height, width = screen.getmaxyx()
+            rows = max(height - 2, 1)
+            cursor = min(cursor, max(len(results) - 1, 0))
+            top = cursor - cursor % rows
+            screen.erase()
+            screen.addnstr(0, 0, f'Filter: {query}', width - 1)
+            screen.addnstr(1, 0, (
+                f'{len(results)}/{len(tagslist)} tags, {len(marked)} '
+                f'marked. Tab mark, ^A mark all, Enter select, Esc quit'
+                ), width - 1, curses.A_DIM)
+            for row, n in enumerate(results[top:top+rows], 2):
+                mark = '*' if n in marked else ' '
+                attr = curses.A_REVERSE if top + row - 2 == cursor else 0
+                text = f'{mark}{n+1: >{d}}. {tagslist[n]}'
+                screen.addnstr(row, 0, text, width - 1, attr)
+            screen.refresh()
+            key = screen.get_wch()
+            if key in ('\n', '\r', curses.KEY_ENTER):
+                if marked:
+                    return sorted(n + 1 for n in marked)
+                if results:
+                    return [results[cursor] + 1]
+            elif key == '\x1b':
+                return None
+            elif key == '\t' and results:
+                marked ^= {results[cursor]}
+                cursor += 1
+            elif key == '\x01':
+                if marked.issuperset(results):
+                    marked.difference_update(results)
+                else:
+                    marked.update(results)
+            elif key in (curses.KEY_BACKSPACE, '\x7f', '\b'):
+                if len(stack) > 1:
+                    stack.pop()
+            elif key == curses.KEY_UP:
+                cursor = max(cursor - 1, 0)
+            elif key == curses.KEY_DOWN:
+                cursor += 1
+            elif key == curses.KEY_PPAGE:
+                cursor = max(cursor - rows, 0)
+            elif key == curses.KEY_NPAGE:
+                cursor += rows
+            elif isinstance(key, str) and key.isprintable():
+                new = query + key
+                trigrams = index[0] if index else None
+                results = filter_tags(new, folded, trigrams, results)
+                stack.append((new, results))
+                cursor = 0
+
+    # Esc quits; do not wait the default second for an escape sequence
+    os.environ.setdefault('ESCDELAY', '25')
+    try:
+        return curses.wrapper(picker)
+    except KeyboardInterrupt:
+        return None
 
 
 def display_menu(tagslist, columns=None, pad_lines=0, sep='  '):
@@ -241,28 +1577,54 @@ def display_menu(tagslist, columns=None, pad_lines=0, sep='  '):
     Validates the selection and then returns it
     """
     if args.number:
-        sel = parse_selection(args.number, len(tagslist))
+        if not (sel := check_selection(args.number, tagslist)):
+            sys.exit(1)
+        return sel
+    if args.filter and not args.menu_only:
+        if not (numbers := filter_menu(tagslist)):
+            print('No selection made. Bye.')
+            sys.exit()
+        sel = numbers_to_selection(numbers)
+        update_state(last_selection=sel)
+        print(f'Selected: {describe_selection(sel, tagslist)}')
         return sel
-    l = format_items(tagslist, sep=sep)
-    formatted_table = make_table(l, columns, pad_lines, sep)
-    print('\n'.join(formatted_table))
+    pager = MenuPager(tagslist, columns, pad_lines, sep) if args.page else None
+    if not pager:
+        l = format_items(tagslist, sep=sep)
+        formatted_table = make_table(l, columns, pad_lines, sep)
+        print('\n'.join(formatted_table))
     n = len(tagslist)
-    if args.menu_only:
-        sys.exit()
     default = ''
-    j = read_jsonfile()
-    if (d := j[csvfile]['last_selection']):
-        default = ','.join(str(s) for s in d)
-    message = '\n'.join([
-        'Info: Use commas to separate multiple entries and dash for ranges.',
-        f"Select one or more numbers from the list "
-        f"[{f'1-{n}' if n>1 else '1'},q] (default={default or 'none'}): "
-        ])
-    try:
-        sel = input(message) or default
-    except KeyboardInterrupt:
-        print(f"\n--> Keyboard interrupt pressed <--\nBye!")
-        sys.exit(1)
+    if (d := read_state()['last_selection']):
+        # Older versions saved a list of numbers
+        default = d if isinstance(d, str) else ','.join(str(s) for s in d)
+    while True:
+        info = []
+        if pager:
+            args.page = min(max(args.page, 1), len(pager.pages))
+            pager.print_page(args.page - 1)
+            info = [
+                f'Info: Page {args.page}/{len(pager.pages)}. '
+                'Enter `>` for the next page or `<` for the previous.'
+                ]
+        if args.menu_only:
+            sys.exit()
+        message = '\n'.join(info + [
+            'Info: Use commas to separate multiple entries and dash for '
+            'ranges.',
+            'Info: Use `&` for entries in both, `~` to exclude, '
+            'parentheses to group and "quotes" for tag names.',
+            f"Select one or more numbers from the list "
+            f"[{f'1-{n}' if n>1 else '1'},q] (default={default or 'none'}): "
+            ])
+        try:
+            sel = input(message) or default
+        except KeyboardInterrupt:
+            print(f"\n--> Keyboard interrupt pressed <--\nBye!")
+            sys.exit(1)
+        if not (pager and sel.strip() in ('>', '<')):
+            break
+        args.page += 1 if sel.strip() == '>' else -1
     # Validate selection
     if sel.lower().startswith('q'):
         print('`q` pressed.\nProgram will now quit.\nBye.')
@@ -272,19 +1634,17 @@ def display_menu(tagslist, columns=None, pad_lines=0, sep='  '):
         print('No selection made. Try again')
         sel = display_menu(tagslist)
     else:
-        sel = parse_selection(sel, n)
+        sel = check_selection(sel, tagslist)
         if not sel:
             sel = display_menu(tagslist)
-    j[csvfile]['last_selection'] = sel
-    write_jsonfile(j)
-    seltxt = ', '.join(f'`{l[int(i)-1].removesuffix(sep)}`' for i in sel)
-    print(f'Selected: {seltxt}')
+    update_state(last_selection=sel)
+    print(f'Selected: {describe_selection(sel, tagslist)}')
     return sel
 
 
-def parse_selection(selection, n):
+def selection_numbers(selection, n):
     """Takes a selection string and the max number of selections.
-    Validates the input. Returns false if not valid. Else returns list.
+    Returns the list of numbers. Raises ValueError if not valid
     """
     selectlist = selection.replace(' ', '').split(',')
     tmplist = []
@@ -292,26 +1652,229 @@ def parse_selection(selection, n):
         if item.count('-') == 1:
             rangestart , rangeend = item.split('-')
             if (rangestart.isdecimal() and rangeend.isdecimal() and
-                int(rangeend)+1 >= int(rangestart)):
+                int(rangeend)+1 >= int(rangestart) and
+                int(rangestart) > 0 and int(rangeend) <= n):
                 rangelist = range(int(rangestart), int(rangeend)+1)
                 tmplist.extend(rangelist)
             else:
-                print(f'Invalid input: `{item}`')
-                return False
+                raise ValueError(f'Invalid input: `{item}`')
         elif item.isdecimal() and all((int(item)>0, int(item)<=n)):
             tmplist.append(int(item))
         else:
-            print(f'Invalid input: `{item}`')
-            return False
+            raise ValueError(f'Invalid input: `{item}`')
     return tmplist
 
 
+def tokenize_selection(selection):
+    """Splits a selection expression into a list of (kind, value) tokens.
+    Kinds are 'num', 'range', 'tag', the parentheses and the operators
+    '|' (union), '&' (intersection) and '-' (difference, `~` or a dash
+    which is not between two numbers)
+    """
+    import re
+    # A dash between two numbers is a range, spaced or not
+    number = re.compile(r'(\d+)(?:\s*-\s*(\d+))?(?![^\s,|+&()~-])')
+    # A tag name may contain spaces and dashes but not ` - `
+    word = re.compile(r'(?:[^,|+&()"\'\s~-]|-|\s+(?=[^,|+&()"\'\s~-]))+')
+    tokens = []
+    i = 0
+    while i < len(selection):
+        c = selection[i]
+        if c.isspace():
+            i += 1
+        elif c in _selection_ops:
+            tokens.append((_selection_ops[c], c))
+            i += 1
+        elif c in '()':
+            tokens.append((c, c))
+            i += 1
+        elif c in '"\'':
+            end = selection.find(c, i+1)
+            if end < 0:
+                raise ValueError(f'Invalid input: `{selection[i:]}`')
+            tokens.append(('tag', selection[i+1:end]))
+            i = end + 1
+        elif (m := number.match(selection, i)):
+            if m[2]:
+                tokens.append(('range', (int(m[1]), int(m[2]))))
+            else:
+                tokens.append(('num', int(m[1])))
+            i = m.end()
+        else:
+            m = word.match(selection, i)
+            tokens.append(('tag', m[0]))
+            i = m.end()
+    return tokens
+
+
+def compile_selection(selection):
+    """Compiles a selection expression to a tuple of postfix operations
+    (see parse_selection_ops). The most recently used are kept, so the
+    --serve daemon doesn't keep every query it was sent
+    """
+    global _compiled_selections
+    if _compiled_selections is None:
+        import functools
+        _compiled_selections = functools.lru_cache(
+            maxsize=_compiled_selections_max,
+            )(parse_selection_ops)
+    return _compiled_selections(selection)
+
+
+def parse_selection_ops(selection):
+    """Compiles a selection expression to a tuple of postfix operations.
+    Raises ValueError if not valid. From loosest to tightest binding:
+        expr := term (('|' | '-') term)*
+        term := atom ('&' atom)*
+        atom := NUMBER | NUMBER-NUMBER | TAG | '(' expr ')'
+    """
+    tokens = tokenize_selection(selection)
+    ops = []
+    pos = 0
+
+    def expect(*kinds):
+        nonlocal pos
+        if pos >= len(tokens) or tokens[pos][0] not in kinds:
+            near = tokens[pos][1] if pos < len(tokens) else 'end of input'
+            raise ValueError(f'Invalid input: `{selection}` near `{near}`')
+        pos += 1
+        return tokens[pos-1]
+
+    def atom():
+        kind, value = expect('num', 'range', 'tag', '(')
+        if kind == '(':
+            expr()
+            expect(')')
+        else:
+            ops.append((kind, value))
+
+    def term():
+        atom()
+        while pos < len(tokens) and tokens[pos][0] == '&':
+            expect('&')
+            atom()
+            ops.append(('&', None))
+
+    def expr():
+        term()
+        while pos < len(tokens) and tokens[pos][0] in '|-':
+            kind, _ = expect('|', '-')
+            term()
+            ops.append((kind, None))
+
+    expr()
+    if pos != len(tokens):
+        raise ValueError(f'Invalid input: `{tokens[pos][1]}`')
+    return tuple(ops)
+
+
+def find_tag(name, tags):
+    """Takes a tag name and the known tags. Returns the tag, matching
+    case insensitively if needed. Raises ValueError if not found
+    """
+    if name in tags:
+        return name
+    matches = [tag for tag in tags if tag.casefold() == name.casefold()]
+    if len(matches) != 1:
+        raise ValueError(f'Invalid input: unknown tag `{name}`')
+    return matches[0]
+
+
+def selection_operands(selection, tagslist, tags=None):
+    """Compiles a selection expression and resolves its operands.
+    Returns postfix operations where each operand is ('tags', names).
+    Raises ValueError if not valid
+    """
+    tags = tags if tags is not None else tagslist
+    n = len(tagslist)
+    operations = []
+    for kind, value in compile_selection(selection):
+        if kind == 'num':
+            if not 0 < value <= n:
+                raise ValueError(f'Invalid input: `{value}`')
+            operations.append(('tags', (tagslist[value-1],)))
+        elif kind == 'range':
+            start, end = value
+            if not (0 < start and end <= n and end+1 >= start):
+                raise ValueError(f'Invalid input: `{start}-{end}`')
+            operations.append(('tags', tuple(tagslist[start-1:end])))
+        elif kind == 'tag':
+            operations.append(('tags', (find_tag(value, tags),)))
+        else:
+            operations.append((kind, None))
+    return operations
+
+
+def check_selection(selection, tagslist):
+    """Takes a selection expression and the menu tags. Validates the
+    input. Returns false if not valid. Else returns the selection
+    """
+    try:
+        selection_operands(selection, tagslist)
+    except ValueError as e:
+        print(e)
+        return False
+    return selection
+
+
+def describe_selection(selection, tagslist):
+    """Returns the selection expression with numbers replaced by tags"""
+    text = {'|': ' | ', '&': ' & ', '-': ' ~ ', '(': '(', ')': ')'}
+    tokens = tokenize_selection(selection)
+    # A range stands for one operand once other operators are involved
+    grouped = any(kind in '&-' for kind, _ in tokens)
+    parts = []
+    for kind, value in tokens:
+        if kind == 'num':
+            parts.append(f'`{tagslist[value-1]}`')
+        elif kind == 'range':
+            start, end = value
+            tags = ', '.join(f'`{tag}`' for tag in tagslist[start-1:end])
+            parts.append(f'({tags})' if grouped else tags)
+        elif kind == 'tag':
+            parts.append(f'`{find_tag(value, tagslist)}`')
+        elif value == ',':
+            parts.append(', ')
+        else:
+            parts.append(text[kind])
+    return ''.join(parts)
+
+
+def ids_to_bitset(ids, size):
+    """Takes host ids and the number of hosts. Returns an int bitset"""
+    import collections
+    import itertools
+    # One byte per host set without a python loop, then read as base 2
+    flags = bytearray(size)
+    collections.deque(
+        map(flags.__setitem__, ids, itertools.repeat(1)),
+        maxlen=0,
+        )
+    return int(flags.translate(_bits_table)[::-1] or b'0', 2)
+
+
+def bitset_to_ids(bitset):
+    """Takes an int bitset. Returns the ids of the set bits in order"""
+    import itertools
+    bits = bin(bitset)[:1:-1]
+    if bits.count('1') * 5 > len(bits):
+        flags = map('1'.__eq__, bits)
+        return list(itertools.compress(range(len(bits)), flags))
+    # Sparse: jump from one set bit to the next
+    ids = []
+    find = bits.find
+    i = find('1')
+    while i >= 0:
+        ids.append(i)
+        i = find('1', i + 1)
+    return ids
+
+
 def get_username():
     """Read last used username from json file. If modified, save new user"""
     if not args.user:
         default = ''
-        j = read_jsonfile()
-        if (d := j[csvfile]['user']):
+        if (d := read_state()['user']):
             default = d
         message = f"Enter username (default={default or 'none'}): "
         try:
@@ -319,8 +1882,7 @@ def get_username():
         except KeyboardInterrupt:
             print(f"\n--> Keyboard interrupt pressed <--\nBye!")
             sys.exit(1)
-        j[csvfile]['user'] = user
-        write_jsonfile(j)
+        update_state(user=user)
     elif args.user:
         user = args.user
     else:
@@ -328,56 +1890,1062 @@ def get_username():
     return user
 
 
-def send_list_to_ssh_or_display(sshaddrs, user):
-    """Create the string of user@host entries provided to ssh via tmux"""
+async def probe_host(host, port, timeout, semaphore):
+    """Attempts a TCP connection to the host. Returns True if it connects"""
+    import asyncio
+    async with semaphore:
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port),
+                timeout,
+                )
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+
+async def probe_hosts_async(
+        hosts, port, timeout, limit, ports=None, addresses=None):
+    """Probes all hosts concurrently. Returns a list of True/False results"""
+    import asyncio
+    ports = ports or {}
+    addresses = addresses or {}
+    semaphore = asyncio.Semaphore(max(limit, 1))
+    return await asyncio.gather(*(
+        probe_host(
+            addresses.get(host, host), ports.get(host, port), timeout,
+            semaphore,
+            )
+        for host in hosts
+        ))
+
+
+def probe_hosts(
+        hosts, port=22, timeout=3.0, limit=64, ports=None, addresses=None):
+    """Takes a list of hosts. Probes them with a bounded number of
+    concurrent TCP connections, on the port given for the host in ports
+    if any, to its address in addresses if any. Returns the lists of up
+    and down hosts
+    """
+    import asyncio
+    results = asyncio.run(
+        probe_hosts_async(hosts, port, timeout, limit, ports, addresses),
+        )
+    up = [host for host, ok in zip(hosts, results) if ok]
+    down = [host for host, ok in zip(hosts, results) if not ok]
+    return up, down
+
+
+def default_resolver(host):
+    """Returns the first address of the host, in the system's order of
+    preference. Raises OSError if it has none
+    """
+    import socket
+    return socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)[0][4][0]
+
+
+def read_dnscache(f=_dnscache):
+    """Returns the unexpired entries of the address cache file as a dict
+    of host to [address, expiry time]
+    """
+    import json
+    import pathlib
+    import time
+    try:
+        jsonobj = json.loads(pathlib.Path(f).read_text())
+        now = time.time()
+        return {
+            host: [address, expires]
+            for host, (address, expires) in jsonobj.items()
+            if isinstance(address, str) and expires > now
+            }
+    except (OSError, ValueError, TypeError, AttributeError):
+        return {}
+
+
+def resolve_hosts(
+        hosts, limit=16, ttl=300, timeout=10.0, resolver=None, f=_dnscache):
+    """Takes a list of hosts. Returns a dict of host to address. Addresses
+    come from the cache file f, else from resolver (default_resolver) run
+    in a pool of at most limit threads, and are cached for ttl seconds.
+    IP addresses, failed lookups and lookups taking over timeout seconds
+    in all are left out, so ssh looks those up itself
+    """
+    import fcntl
+    import ipaddress
+    import queue
+    import threading
+    import time
+    resolver = resolver or default_resolver
+    cache = read_dnscache(f)
+    addresses = {}
+    missing = []
+    for host in dict.fromkeys(hosts):
+        if host in cache:
+            addresses[host] = cache[host][0]
+            continue
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            missing.append(host)
+    if not missing:
+        return addresses
+    jobs = queue.SimpleQueue()
+    for host in missing:
+        jobs.put(host)
+    results = {}
+    stop = threading.Event()
+
+    def work():
+        while not stop.is_set():
+            try:
+                host = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[host] = resolver(host)
+            except (OSError, UnicodeError):
+                pass
+
+    # Daemon threads, so a lookup which never returns doesn't hold up exit
+    threads = [
+        threading.Thread(target=work, daemon=True)
+        for _ in range(min(max(limit, 1), len(missing)))
+        ]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+    stop.set()
+    resolved = dict(results)
+    if resolved:
+        expires = time.time() + ttl
+        os.makedirs(os.path.dirname(f), exist_ok=True)
+        # Merge with the entries cached by concurrent runs meanwhile
+        with open(f'{f}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cache = read_dnscache(f)
+            cache.update((h, [a, expires]) for h, a in resolved.items())
+            write_jsonfile(cache, f)
+    addresses.update(resolved)
+    return addresses
+
+
+def send_list_to_ssh_or_display(sshaddrs, user, ssh_options=None):
+    """Create the ssh command of each address provided to tmux.
+    With --debug, prints the argv of each pane and the tmux script
+    """
+    control_persist = control_persist_option()
+    delays = None
+    if args.rate:
+        delays = launch_delays(
+            len(sshaddrs), args.rate, args.burst, args.jitter,
+            )
     if args.debug:
-        sshlist = ' '.join(f'{user}@{h}' for h in sshaddrs)
-        print(sshlist)
+        import shlex
+        ssh_options = ssh_options or {}
+        for h in sshaddrs:
+            argv = ssh_argv(h, user, ssh_options.get(h), control_persist)
+            print(shlex.join(argv))
+        commands = tmux_launch_commands(
+            sshaddrs,
+            user,
+            max_panes=args.max_panes,
+            broadcast=args.broadcast,
+            ssh_options=ssh_options,
+            control_persist=control_persist,
+            delays=delays,
+            csv=csvfile,
+            reuse=not args.new_session,
+            update=args.update_session,
+            log_dir=args.log_dir,
+            log_max_size=args.log_max_size,
+            history_limit=args.history_limit,
+            )
+        print(tmux_script(commands))
         return None
     else:
-        rval = mssh_using_tmux(sshaddrs, user)
+        if control_persist:
+            os.makedirs(_controldir, mode=0o700, exist_ok=True)
+        rval = mssh_using_tmux(
+            sshaddrs,
+            user,
+            max_panes=args.max_panes,
+            broadcast=args.broadcast,
+            ssh_options=ssh_options,
+            control_persist=control_persist,
+            delays=delays,
+            csv=csvfile,
+            reuse=not args.new_session,
+            update=args.update_session,
+            log_dir=args.log_dir,
+            log_max_size=args.log_max_size,
+            history_limit=args.history_limit,
+            )
         return rval
 
 
-def mssh_using_tmux(sshlist, user):
-    """Creates a new tmux session using the supplied list of addresses"""
+def control_persist_option():
+    """Returns the --control-persist time, None if sharing is disabled.
+    A one-off --exec leaves no master connections behind unless asked to
+    """
+    control_persist = args.control_persist or ('no' if args.command else '10m')
+    if control_persist.lower() == 'no':
+        return None
+    return control_persist
+
+
+def exec_on_hosts(sshaddrs, user, ssh_options=None):
+    """Runs the --exec command on the addresses over ssh. With --debug,
+    prints the argv of each instead. Returns the exit code for the program
+    """
+    import shlex
+    ssh_options = ssh_options or {}
+    control_persist = control_persist_option()
+    argvs = {
+        h: [*ssh_argv(h, user, ssh_options.get(h), control_persist, True),
+            args.command]
+        for h in sshaddrs
+        }
+    if args.debug:
+        for argv in argvs.values():
+            print(shlex.join(argv))
+        return 0
+    if control_persist:
+        os.makedirs(_controldir, mode=0o700, exist_ok=True)
+    results = exec_hosts(argvs, args.exec_limit, args.fail_fast)
+    print_exec_summary(results)
+    return 0 if all(r[0] == 0 for r in results.values()) else 1
+
+
+def exec_hosts(argvs, limit=32, fail_fast=False):
+    """Takes a dictionary of host to argv. Runs them concurrently, at most
+    limit at a time. Returns a dictionary of host to (exit code, seconds),
+    the exit code None for a host not run because of fail_fast
+    """
+    import asyncio
+    return asyncio.run(exec_hosts_async(argvs, limit, fail_fast))
+
+
+async def exec_hosts_async(argvs, limit, fail_fast):
+    """Runs the argvs concurrently. Returns the results of exec_hosts"""
+    import asyncio
+    semaphore = asyncio.Semaphore(max(limit, 1))
+    width = max(map(len, argvs), default=0)
+    results = dict.fromkeys(argvs, (None, 0.0))
+    running = {}
+    stopped = asyncio.Event()
+
+    async def run(host, argv):
+        async with semaphore:
+            if stopped.is_set():
+                return
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *argv,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    limit=1 << 20,
+                    )
+            except OSError as e:
+                print(f'{host: <{width}} | {e}', file=sys.stderr)
+                results[host] = (127, loop.time() - start)
+            else:
+                running[host] = proc
+                prefix = f'{host: <{width}} | '
+                await asyncio.gather(
+                    copy_lines(proc.stdout, prefix, sys.stdout),
+                    copy_lines(proc.stderr, prefix, sys.stderr),
+                    )
+                results[host] = (await proc.wait(), loop.time() - start)
+                del running[host]
+            if fail_fast and results[host][0] != 0 and not stopped.is_set():
+                stopped.set()
+                for other in running.values():
+                    other.terminate()
+
+    await asyncio.gather(*(run(h, argv) for h, argv in argvs.items()))
+    return results
+
+
+async def copy_lines(reader, prefix, stream):
+    """Writes each line read from reader to stream after the prefix"""
+    while True:
+        try:
+            line = await reader.readline()
+        except ValueError:
+            # A line over the reader limit; write what is buffered
+            line = await reader.read(1 << 20)
+        if not line:
+            break
+        text = line.decode(errors='replace')
+        stream.write(f'{prefix}{text}' + ('' if text.endswith('\n') else '\n'))
+        stream.flush()
+
+
+def print_exec_summary(results):
+    """Prints the exit code and time of each host and a count of each"""
+    width = max(map(len, results), default=4)
+    lines = ['', f'{"host": <{width}}  exit  seconds']
+    for host, (rval, seconds) in results.items():
+        if rval is None:
+            lines.append(f'{host: <{width}}     -        -')
+        else:
+            lines.append(f'{host: <{width}}  {rval: >4}  {seconds: >7.2f}')
+    codes = [rval for rval, _ in results.values()]
+    failed = sum(1 for rval in codes if rval is not None and rval > 0)
+    # Negative codes are processes ended by a signal, e.g. by --fail-fast
+    stopped = sum(1 for rval in codes if rval is not None and rval < 0)
+    lines.append(
+        f'{codes.count(0)} succeeded, {failed} failed, {stopped} stopped, '
+        f'{codes.count(None)} not run.'
+        )
+    print('\n'.join(lines))
+
+
+def launch_delays(count, rate, burst=1, jitter=0.0):
+    """Returns the seconds each of count connections waits before it
+    starts. A token bucket: burst start at once, then rate per second.
+    Each is pushed back by up to jitter seconds at random
+    """
+    import random
+    burst = max(burst, 1)
+    return [
+        max(n - burst + 1, 0) / rate + random.uniform(0, jitter)
+        for n in range(count)
+        ]
+
+
+def pane_command(argv, delay=None):
+    """Returns the shell command of a pane running argv after delay"""
+    import shlex
+    if not delay:
+        return shlex.join(argv)
+    return f'sleep {delay:.3f}; exec {shlex.join(argv)}'
+
+
+def ssh_argv(host, user, options=None, control_persist=None, batch=False):
+    """Returns the ssh argv of the pane for a host. Takes the ssh options
+    from its typed csv columns. With control_persist, the connections to
+    the host and its jump host are master connections shared through
+    sockets in _controldir, so later panes and runs skip the handshake.
+    With batch, ssh fails instead of asking for a password or passphrase
+    """
+    import shlex
+    options = options or {}
+    control = ['-o', 'BatchMode=yes'] if batch else []
+    if control_persist:
+        control += [
+            '-o', 'ControlMaster=auto',
+            '-o', f'ControlPath={os.path.join(_controldir, "%C")}',
+            '-o', f'ControlPersist={control_persist}',
+            ]
+    argv = ['ssh', *control]
+    if (address := options.get('HostName')):
+        # Connect to the address looked up by --resolve. The destination
+        # stays the host name for ssh_config, known_hosts and titles
+        argv += ['-o', f'HostName={address.replace("%", "%%")}']
+    if (port := options.get('Port')):
+        argv += ['-p', str(port)]
+    if (identity := options.get('IdentityFile')):
+        argv += ['-i', identity]
+    if (jump := options.get('ProxyJump')):
+        # -J would not pass the control options on to the jump host
+        jumpuser, _, jumphost = jump.rpartition('@')
+        jumphost, _, jumpport = jumphost.partition(':')
+        # %C is expanded by the jump ssh, not the one running the command
+        proxy = [o.replace('%', '%%') for o in control]
+        proxy = ['ssh', *proxy, '-W', '%h:%p']
+        if jumpport:
+            proxy += ['-p', jumpport]
+        proxy.append(f'{jumpuser}@{jumphost}' if jumpuser else jumphost)
+        argv += ['-o', f'ProxyCommand={shlex.join(proxy)}']
+    user = options.get('User') or user
+    argv.append(f'{user}@{host}' if user else host)
+    return argv
+
+
+def tmux_session_name():
+    """Returns a new tmux session name based on the current time"""
+    import datetime as dt
     now = dt.datetime.now().replace(microsecond=0)
     tstamp = now.isoformat().translate({ord('-'): '', ord(':'): ''})
-    tmux_session = f'mssh-{tstamp}'
-    window_name = ','.join(sshlist)
-    rval = sh_run(f'tmux new-session -d -s "{tmux_session}"')
-    rval = sh_run(f'tmux rename-window {tmux_session}')
-    #rval = sh_run(f'tmux rename-window "{window_name}"')
-    #rval = sh_run(f'tmux set-option -wg automatic-rename off')
-    #rval = sh_run(f'tmux set-option -wg set-titles on')
-    #rval = sh_run(f'tmux set-option -wg set-titles-string "mssh"')
-    rval = sh_run(f'tmux set-option -wg status-left "[mssh] "')
-    rval = sh_run(f'tmux set-option -wg status-left-length 24')
-    rval = sh_run(f'tmux set-option -g pane-border-status top')
-    rval = sh_run(f'tmux set-option -g pane-border-format " [ ###P #T ] "')
-    rval = sh_run(f'tmux set-option -g base-index 1')
-    rval = sh_run(f'tmux set-option -g pane-base-index 1')
-    for item in sshlist:
-        rval = sh_run(f"tmux split-window 'ssh {user}@{item}'")
-        rval = sh_run(f'tmux select-pane -T "{item}"')
-        rval = sh_run(f'tmux select-layout tiled')
-    rval = sh_run(f'tmux kill-pane -t 1')
-    rval = sh_run(f'tmux set-window-option synchronize-panes on')
-    rval = sh_run(f'tmux select-layout tiled')
-    rval = sh_run(f'tmux attach -t "{tmux_session}"')
-    return rval
-
-
-def sh_run(command):
-    """Runs a shell command via subprocess.run. Return value is int"""
-    rval = subprocess.run(command, shell=True)
+    return f'mssh-{tstamp}'
+
+
+def default_max_panes(min_columns=10, min_lines=4):
+    """Returns the number of panes per window when --max-panes is not
+    given: as many as a tiled layout fits in the terminal with each pane
+    at least min_columns wide and min_lines high, border included
+    """
+    import shutil
+    columns, lines = shutil.get_terminal_size()
+    side = min(columns // min_columns, lines // min_lines)
+    return max(side, 1) ** 2
+
+
+def tmux_session_commands(
+        sshlist, user, tmux_session, max_panes=None, broadcast=False,
+        ssh_options=None, control_persist=None, delays=None,
+        session_options=None, log_dir=None, log_max_size=10,
+        history_limit=None):
+    """Returns the list of tmux commands (each an argv list) which build
+    and attach a session with one synchronized pane per address.
+    Addresses are split into windows of at most max_panes panes (see
+    default_max_panes). The session is the size of the terminal, so
+    the splits fit before it is attached. Each pane waits its delay in
+    seconds, if given, before running ssh. The session_options (e.g. its
+    fingerprint) are set on the session once its panes are built. With a
+    log_dir, the output of each pane is logged (see log_writer)
+    """
+    import shutil
+    ssh_options = ssh_options or {}
+    delays = delays or [None] * len(sshlist)
+    session_options = session_options or {}
+    columns, lines = shutil.get_terminal_size()
+    commands = [
+        [
+            'new-session', '-d', '-s', tmux_session,
+            '-x', str(columns), '-y', str(lines),
+            ],
+        *log_commands(tmux_session, log_dir, log_max_size, history_limit),
+        ['rename-window', tmux_session],
+        ['set-option', '-wg', 'status-left', '[mssh] '],
+        ['set-option', '-wg', 'status-left-length', '24'],
+        ['set-option', '-g', 'pane-border-status', 'top'],
+        ['set-option', '-g', 'pane-border-format', ' [ ###P #T ] '],
+        ['set-option', '-g', 'base-index', '1'],
+        ['set-option', '-g', 'pane-base-index', '1'],
+        ]
+    size = max_panes or default_max_panes()
+    shards = [sshlist[i:i+size] for i in range(0, len(sshlist), size)]
+    for n, shard in enumerate(shards, 1):
+        if n > 1:
+            commands.append(['new-window', '-n', f'{tmux_session}-{n}'])
+        for i, item in enumerate(shard, (n - 1) * size):
+            argv = ssh_argv(
+                item, user, ssh_options.get(item), control_persist,
+                )
+            commands.append(['split-window', pane_command(argv, delays[i])])
+            if log_dir:
+                path = pane_log_path(log_dir, tmux_session, item)
+                commands.append(['pipe-pane', '-o', pane_log_command(path)])
+            commands.append(['select-pane', '-T', item])
+            # The title may be changed by the remote host; this may not
+            commands.append(['set-option', '-p', '@mssh-host', item])
+            # Retile so the active pane has room for the next split
+            commands.append(['select-layout', 'tiled'])
+        # Remove the window's initial shell pane
+        commands += [
+            ['kill-pane', '-t', '1'],
+            ['set-window-option', 'synchronize-panes', 'on'],
+            ['select-layout', 'tiled'],
+            ]
+    if broadcast:
+        commands.append(
+            ['new-window', '-n', 'broadcast', relay_command(tmux_session)],
+            )
+    # Set last, so a session whose build failed is never found for reuse
+    for k, v in session_options.items():
+        commands.append(['set-option', '-t', tmux_session, k, v])
+    commands.append(['attach', '-t', tmux_session])
+    return commands
+
+
+def session_fingerprint(sshlist, user):
+    """Returns a digest of the user and the set of addresses"""
+    import hashlib
+    text = '\n'.join([user, *sorted(set(sshlist))])
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def tmux_output(*argv):
+    """Runs a tmux command. Returns its output lines, none if it fails"""
+    import subprocess
+    try:
+        rval = subprocess.run(['tmux', *argv], capture_output=True, text=True)
+    except OSError:
+        return []
+    return rval.stdout.splitlines() if rval.returncode == 0 else []
+
+
+def find_mssh_session(fingerprint, user, csv, update=False):
+    """Returns the name of the running mssh session with the fingerprint,
+    else with update the newest one for the same user and csv file which
+    no client is attached to, else None
+    """
+    fields = [
+        '#{session_name}', '#{session_created}', '#{session_attached}',
+        '#{@mssh-fingerprint}', '#{@mssh-user}', '#{@mssh-csv}',
+        ]
+    newest = None
+    for line in tmux_output('list-sessions', '-F', '\t'.join(fields)):
+        name, created, attached, fp, u, c = line.split('\t')
+        if not fp:
+            continue
+        if fp == fingerprint:
+            return name
+        # Panes of a session in use in another terminal are not killed
+        if not update or attached != '0' or (u, c) != (user, csv):
+            continue
+        if not newest or int(created) > newest[0]:
+            newest = (int(created), name)
+    return newest and newest[1]
+
+
+def tmux_reuse_commands(
+        tmux_session, sshlist, user, max_panes=None, broadcast=False,
+        ssh_options=None, control_persist=None, delays=None,
+        session_options=None, log_dir=None, log_max_size=10,
+        history_limit=None):
+    """Returns the list of tmux commands which bring a running mssh session
+    to the list of addresses and attach it. Its panes are read with
+    `list-panes`; only panes of addresses no longer selected are killed
+    and only missing addresses get new panes, filling windows up to
+    max_panes panes. Panes are killed before any are added, so full
+    windows make room, except in windows left with none: those would
+    close, so they get no new panes and theirs are killed last. New panes
+    wait delays in the order they are added and are logged to log_dir,
+    if given
+    """
+    ssh_options = ssh_options or {}
+    session_options = session_options or {}
+    fields = ['#{window_id}', '#{window_name}', '#{pane_id}', '#{@mssh-host}']
+    lines = tmux_output(
+        'list-panes', '-s', '-t', tmux_session, '-F', '\t'.join(fields),
+        )
+    wanted = set(sshlist)
+    names = set()
+    # Window id to the number of its host panes kept or added
+    windows = {}
+    panes = {}
+    kills = []
+    for line in lines:
+        window, name, pane, host = line.split('\t')
+        names.add(name)
+        if not host:
+            continue
+        windows.setdefault(window, 0)
+        if host in wanted and host not in panes:
+            panes[host] = pane
+            windows[window] += 1
+        else:
+            kills.append((window, pane))
+    size = max_panes or default_max_panes()
+    missing = [item for item in sshlist if item not in panes]
+    delays = delays or [None] * len(missing)
+    commands = []
+    for window, pane in kills:
+        if windows[window]:
+            commands.append(['kill-pane', '-t', pane])
+    for window in dict.fromkeys(w for w, _ in kills):
+        if windows[window]:
+            commands.append(['select-layout', '-t', window, 'tiled'])
+    # Windows left with no panes take no new ones
+    emptied = [w for w, c in windows.items() if not c]
+    for window in emptied:
+        del windows[window]
+    if missing:
+        commands += log_commands(
+            tmux_session, log_dir, log_max_size, history_limit,
+            )
+    n = 2
+    for item, delay in zip(missing, delays):
+        argv = ssh_argv(item, user, ssh_options.get(item), control_persist)
+        command = pane_command(argv, delay)
+        window = next((w for w, c in windows.items() if c < size), None)
+        if window is None:
+            while f'{tmux_session}-{n}' in names:
+                n += 1
+            names.add(name := f'{tmux_session}-{n}')
+            window = f'{tmux_session}:{name}'
+            windows[window] = 0
+            commands += [
+                ['new-window', '-t', f'{tmux_session}:', '-n', name, command],
+                ['set-window-option', '-t', window, 'synchronize-panes', 'on'],
+                ]
+        else:
+            commands.append(['split-window', '-t', window, command])
+        windows[window] += 1
+        if log_dir:
+            path = pane_log_path(log_dir, tmux_session, item)
+            commands.append(
+                ['pipe-pane', '-t', window, '-o', pane_log_command(path)],
+                )
+        commands += [
+            ['select-pane', '-t', window, '-T', item],
+            ['set-option', '-p', '-t', window, '@mssh-host', item],
+            ['select-layout', '-t', window, 'tiled'],
+            ]
+    for window, pane in kills:
+        if window in emptied:
+            commands.append(['kill-pane', '-t', pane])
+    if broadcast and 'broadcast' not in names:
+        commands.append([
+            'new-window', '-d', '-t', f'{tmux_session}:', '-n', 'broadcast',
+            relay_command(tmux_session),
+            ])
+    for k, v in session_options.items():
+        commands.append(['set-option', '-t', tmux_session, k, v])
+    commands.append(['attach', '-t', tmux_session])
+    return commands
+
+
+def tmux_launch_commands(
+        sshlist, user, csv='', reuse=True, update=False, **kwargs):
+    """Returns the tmux commands which attach the running mssh session
+    for the addresses and user if reuse (or, with update, a detached one
+    for the csv file, brought to the addresses), else build a new one.
+    Takes tmux_session_commands options
+    """
+    fingerprint = session_fingerprint(sshlist, user)
+    session_options = {
+        '@mssh-fingerprint': fingerprint,
+        '@mssh-user': user,
+        '@mssh-csv': csv,
+        }
+    if reuse and (tmux_session := find_mssh_session(
+            fingerprint, user, csv, update)):
+        return tmux_reuse_commands(
+            tmux_session, sshlist, user,
+            session_options=session_options, **kwargs,
+            )
+    return tmux_session_commands(
+        sshlist, user, tmux_session_name(),
+        session_options=session_options, **kwargs,
+        )
+
+
+def relay_command(tmux_session):
+    """Returns the shell command which runs relay_input for the session"""
+    import shlex
+    script = os.path.abspath(sys.argv[0])
+    return shlex.join([sys.executable, script, '--relay', tmux_session])
+
+
+def relay_input(tmux_session):
+    """Reads raw keystrokes from the terminal and sends them to every other
+    window of the tmux session. Synchronized panes repeat them to each
+    pane of their window. Ctrl-] stops the relay
+    """
+    import subprocess
+    import termios
+    import tty
+    own = subprocess.run(
+        ['tmux', 'display-message', '-p', '#{window_id}'],
+        capture_output=True,
+        text=True,
+        ).stdout.strip()
+    print(
+        f'Keystrokes typed here are sent to every window of {tmux_session}.'
+        f'\nPress Ctrl-] to stop.'
+        )
+    fd = sys.stdin.fileno()
+    saved = termios.tcgetattr(fd)
+    tty.setraw(fd)
+    try:
+        while (data := os.read(fd, 1024)) and b'\x1d' not in data:
+            windows = subprocess.run(
+                ['tmux', 'list-windows', '-t', tmux_session,
+                 '-F', '#{window_id}'],
+                capture_output=True,
+                text=True,
+                ).stdout.split()
+            keys = [f'{b:02x}' for b in data]
+            commands = [
+                ['send-keys', '-t', window, '-H', *keys]
+                for window in windows if window != own
+                ]
+            if commands:
+                tmux_run(commands)
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+
+
+def log_commands(tmux_session, log_dir, log_max_size, history_limit):
+    """Returns the tmux commands which set the history limit of new panes
+    and start the log writer of the session, if a log_dir is given. A
+    writer already running for the session keeps the job
+    """
+    import shlex
+    commands = []
+    if history_limit is not None:
+        commands.append(
+            ['set-option', '-g', 'history-limit', str(history_limit)],
+            )
+    if log_dir:
+        script = os.path.abspath(sys.argv[0])
+        directory = session_log_dir(log_dir, tmux_session)
+        command = shlex.join([
+            sys.executable, script, '--log-writer', directory,
+            tmux_session, '--log-max-size', str(log_max_size),
+            ])
+        commands.append(['run-shell', '-b', command])
+    return commands
+
+
+def log_file_name(name):
+    """Returns a session or host name made safe for a file name"""
+    import re
+    return re.sub(r'[^\w.@-]', '_', name)
+
+
+def session_log_dir(log_dir, tmux_session):
+    """Returns the directory of the pane logs of a session"""
+    log_dir = os.path.abspath(os.path.expanduser(log_dir))
+    return os.path.join(log_dir, log_file_name(tmux_session))
+
+
+def pane_log_path(log_dir, tmux_session, host):
+    """Returns the path of the FIFO which takes the output of the pane of
+    host. Its log file is the same path ending in .log
+    """
+    return os.path.join(
+        session_log_dir(log_dir, tmux_session), f'{log_file_name(host)}.fifo',
+        )
+
+
+def pane_log_command(path):
+    """Returns the `pipe-pane` shell command which sends the output of a
+    pane to the FIFO at path, read by log_writer
+    """
+    import shlex
+    d = shlex.quote(os.path.dirname(path))
+    f = shlex.quote(path)
+    return f'mkdir -p {d} && {{ [ -p {f} ] || mkfifo {f}; }} && exec cat >>{f}'
+
+
+def strip_control(data):
+    """Takes bytes of terminal output. Returns them without escape sequences
+    and control characters other than newline and tab, and a trailing
+    incomplete escape sequence to prepend to the next bytes
+    """
+    import re
+    escapes = re.compile(_log_escapes)
+    tail = b''
+    # The earliest sequence running on to the end, e.g. an OSC title cut
+    # between its text and the ESC of its `ESC \` terminator
+    m = re.search(_log_partial, data)
+    if m and len(data) - m.start() <= _log_partial_max:
+        data, tail = data[:m.start()], data[m.start():]
+    elif data.endswith(b'\r'):
+        data, tail = data[:-1], b'\r'
+    return escapes.sub(b'', data).replace(b'\r\n', b'\n'), tail
+
+
+class PaneLog:
+    """Buffered log file of one pane. Once the file would grow past
+    max_bytes it is renamed to the next free NAME.N.log and gzipped in the
+    background
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.buffer = bytearray()
+        self.tail = b''
+        try:
+            self.size = os.path.getsize(path)
+        except OSError:
+            self.size = 0
+
+    def write(self, data):
+        """Buffers the text of data, and writes it once enough is buffered"""
+        text, self.tail = strip_control(self.tail + data)
+        self.buffer += text
+        if len(self.buffer) >= _log_buffer_bytes:
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered text to the log file, rotating it so no
+        segment grows past max_bytes
+        """
+        while self.size + len(self.buffer) > self.max_bytes:
+            room = max(self.max_bytes - self.size, 0)
+            # End the segment with the last whole line which fits, else
+            # start a new one. Only a line longer than max_bytes is cut
+            cut = self.buffer.rfind(b'\n', 0, room) + 1
+            if not cut and not self.size:
+                cut = room
+            if cut:
+                self.append(self.buffer[:cut])
+                del self.buffer[:cut]
+            self.rotate()
+        if self.buffer:
+            self.append(self.buffer)
+            self.buffer.clear()
+
+    def append(self, data):
+        """Appends data to the log file"""
+        with open(self.path, 'ab') as f:
+            f.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        """Moves the log file to the next segment and compresses it"""
+        import threading
+        base = self.path.removesuffix('.log')
+        n = 1
+        while any(os.path.exists(f'{base}.{n}.log{e}') for e in ('', '.gz')):
+            n += 1
+        segment = f'{base}.{n}.log'
+        os.replace(self.path, segment)
+        self.size = 0
+        threading.Thread(target=gzip_file, args=(segment,)).start()
+
+
+def gzip_file(path):
+    """Compresses the file at path to path.gz and removes it"""
+    import gzip
+    import shutil
+    with open(path, 'rb') as src, gzip.open(f'{path}.gz.tmp', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(f'{path}.gz.tmp', f'{path}.gz')
+    os.remove(path)
+
+
+def log_writer(directory, tmux_session, max_bytes):
+    """Writes the output of the panes of a tmux session, sent to the FIFOs
+    in directory by `pipe-pane`, to a PaneLog each. New FIFOs are picked
+    up every second. Stops once the session is gone
+    """
+    import fcntl
+    import selectors
+    import subprocess
+    import time
+    os.makedirs(directory, exist_ok=True)
+    lock = open(os.path.join(directory, '.writer.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return
+    selector = selectors.DefaultSelector()
+    logs = {}
+    scanned = checked = 0.0
+    while True:
+        now = time.monotonic()
+        if now - scanned >= 1:
+            scanned = now
+            for log in logs.values():
+                log.flush()
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if name.endswith('.fifo') and path not in logs:
+                    # Opened for writing too so it never reads end of file
+                    fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+                    log = PaneLog(
+                        f'{path.removesuffix(".fifo")}.log', max_bytes,
+                        )
+                    logs[path] = log
+                    selector.register(fd, selectors.EVENT_READ, log)
+        if now - checked >= 5:
+            checked = now
+            alive = subprocess.run(
+                ['tmux', 'has-session', '-t', f'={tmux_session}'],
+                capture_output=True,
+                )
+            if alive.returncode:
+                break
+        for key, _ in selector.select(timeout=1):
+            try:
+                key.data.write(os.read(key.fd, 1 << 16))
+            except BlockingIOError:
+                pass
+    for path, log in logs.items():
+        log.flush()
+        os.remove(path)
+
+
+def tmux_script(commands):
+    """Takes a list of tmux commands. Returns them as a tmux script"""
+    import shlex
+    return '\n'.join(shlex.join(command) for command in commands)
+
+
+def tmux_argv(commands):
+    """Takes a list of tmux commands. Returns one `;` separated tmux argv"""
+    argv = ['tmux']
+    for command in commands:
+        argv.extend([*command, ';'])
+    return argv[:-1]
+
+
+def mssh_using_tmux(
+        sshlist, user, max_panes=None, broadcast=False, ssh_options=None,
+        control_persist=None, delays=None, csv='', reuse=True, update=False,
+        log_dir=None, log_max_size=10, history_limit=None):
+    """Creates a new tmux session using the supplied list of addresses,
+    or reuses a running one (see tmux_launch_commands), and attaches it.
+    tmux skips the rest of a batch after a failed command, so a new
+    session which could not be built is killed instead of attached
+    """
+    commands = tmux_launch_commands(
+        sshlist,
+        user,
+        csv=csv,
+        reuse=reuse,
+        update=update,
+        max_panes=max_panes,
+        broadcast=broadcast,
+        ssh_options=ssh_options,
+        control_persist=control_persist,
+        delays=delays,
+        log_dir=log_dir,
+        log_max_size=log_max_size,
+        history_limit=history_limit,
+        )
+    *commands, attach = commands
+    rval = tmux_run(commands)
+    if rval != 0:
+        if commands[0][0] == 'new-session':
+            tmux_run([['kill-session', '-t', attach[-1]]])
+        print('[ERROR]: The tmux session could not be built. Bye.')
+        return rval
+    return tmux_run([attach])
+
+
+def tmux_run(commands):
+    """Runs a list of tmux commands with a single tmux client.
+    Return value is int
+    """
+    import subprocess
+    rval = subprocess.run(tmux_argv(commands))
     return rval.returncode
 
 
+def start_profile(trace=None, dump=None):
+    """Wraps the functions in _profiled and subprocess.Popen to record
+    their wall time and spawns, and prints the report at exit. Nothing
+    is wrapped unless this is called
+    """
+    global _profile
+    import atexit
+    import subprocess
+    import time
+    _profile = {
+        'start': time.perf_counter(),
+        'stages': {},
+        'spawns': 0,
+        'events': [] if trace else None,
+        }
+    for name in _profiled:
+        owner, _, attr = name.rpartition('.')
+        owner = globals()[owner] if owner else sys.modules[__name__]
+        setattr(owner, attr, timed(name, getattr(owner, attr)))
+
+    class Popen(subprocess.Popen):
+        def __init__(self, *a, **kw):
+            _profile['spawns'] += 1
+            if _profile['events'] is not None:
+                argv = a[0] if a else kw.get('args')
+                _profile['events'].append(trace_event(
+                    'spawn', time.perf_counter(), ph='i',
+                    args={'argv': str(argv)[:200]},
+                    ))
+            super().__init__(*a, **kw)
+
+    subprocess.Popen = Popen
+    profiler = None
+    if dump:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    # Registered first so it runs after write_state and the other atexits
+    atexit.register(report_profile, trace, dump, profiler)
+
+
+def timed(name, func):
+    """Returns func wrapped to add its wall time to the profile"""
+    import functools
+    import time
+
+    @functools.wraps(func)
+    def wrapper(*a, **kw):
+        stage = _profile['stages'].setdefault(name, [0, 0.0])
+        start = time.perf_counter()
+        try:
+            return func(*a, **kw)
+        finally:
+            end = time.perf_counter()
+            stage[0] += 1
+            stage[1] += end - start
+            if _profile['events'] is not None:
+                _profile['events'].append(
+                    trace_event(name, start, dur=end - start),
+                    )
+    return wrapper
+
+
+def trace_event(name, start, ph='X', **fields):
+    """Returns a Chrome trace event starting at a perf_counter time"""
+    event = {
+        'name': name,
+        'ph': ph,
+        'ts': round((start - _profile['start']) * 1e6, 1),
+        'pid': os.getpid(),
+        'tid': 1,
+        }
+    if 'dur' in fields:
+        fields['dur'] = round(fields['dur'] * 1e6, 1)
+    event.update(fields)
+    return event
+
+
+def peak_rss():
+    """Returns the peak resident memory of the process in bytes"""
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def report_profile(trace=None, dump=None, profiler=None):
+    """Prints the time per stage (inclusive of the stages it calls), the
+    subprocess count and the peak RSS to stderr. Writes the trace and
+    cProfile files when given
+    """
+    import time
+    total = time.perf_counter() - _profile['start']
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(dump)
+    width = max(map(len, _profile['stages']), default=5)
+    lines = [f'{"stage": <{width}}  calls        ms']
+    for name, (calls, seconds) in _profile['stages'].items():
+        lines.append(f'{name: <{width}}  {calls: >5}  {seconds*1000: >8.1f}')
+    lines += [
+        f'{"total": <{width}}         {total*1000: >8.1f}',
+        f'Subprocesses: {_profile["spawns"]}',
+        f'Peak RSS: {peak_rss() / 2**20:.1f} MiB',
+        ]
+    print('\n'.join(lines), file=sys.stderr)
+    if trace:
+        import json
+        with open(trace, 'w') as f:
+            json.dump({'traceEvents': _profile['events']}, f)
+
+
 def print_completion(shell):
     """Read a completion file and print the output"""
     resource = f"shell-completions/{shell}/{__script__}"
-    completions = importlib.resources.files(__module__).joinpath(resource)
+    completions = os.path.join(os.path.dirname(__file__), resource)
+    if os.path.exists(completions):
+        with open(completions) as f:
+            print(f.read())
+        return
+    # Packaged in a zipapp, read through the import system instead
+    import importlib.resources
+    package = __package__ or __module__
+    completions = importlib.resources.files(package).joinpath(resource)
     if completions.exists():
         print(completions.read_text())
     else:
@@ -385,18 +2953,115 @@ def print_completion(shell):
         sys.exit(1)
 
 
+def fast_path(argv):
+    """Handles `--version`, `--completion SHELL` and `--complete-tags`
+    without building the argument parser. Returns True if handled
+    """
+    if argv in (['-v'], ['--version']):
+        # Spaces collapsed as argparse does when it prints the version
+        print(' '.join((_version % {'prog': __script__}).split()))
+        return True
+    if len(argv) == 1 and argv[0].startswith('--completion='):
+        argv = argv[0].split('=', 1)
+    if (len(argv) == 2 and argv[0] == '--completion'
+            and argv[1] in _completion_shells):
+        print_completion(argv[1])
+        return True
+    if argv[:1] == ['--complete-tags']:
+        complete_tags(argv[1:])
+        return True
+    return False
+
+
 def main():
     """Start of main program"""
     global args
     global csvfile
+    if fast_path(sys.argv[1:]):
+        return
+    import pathlib
+    import shutil
     parser = parse_arguments()
     args = parser.parse_args()
+    if args.profile or args.profile_trace or args.profile_dump:
+        start_profile(args.profile_trace, args.profile_dump)
     if (shell := args.completion):
         print_completion(shell)
         return
+    if args.complete_tags is not None:
+        complete_tags(args.complete_tags)
+        return
+    if (tmux_session := args.relay):
+        relay_input(tmux_session)
+        return
+    if args.log_writer:
+        log_writer(*args.log_writer, args.log_max_size << 20)
+        return
+    if args.serve:
+        serve()
+        return
+    if args.max_panes is not None and args.max_panes < 1:
+        parser.error('--max-panes must be 1 or more')
+    if args.exec_limit < 1:
+        parser.error('--exec-limit must be 1 or more')
+    if args.fail_fast and not args.command:
+        parser.error('--fail-fast requires --exec')
+    if args.rate is not None and args.rate <= 0:
+        parser.error('--rate must be more than 0')
+    if args.burst < 1:
+        parser.error('--burst must be 1 or more')
+    if args.jitter < 0:
+        parser.error('--jitter must be 0 or more')
+    if args.jitter and args.rate is None:
+        parser.error('--jitter requires --rate')
+    if args.resolve_limit < 1:
+        parser.error('--resolve-limit must be 1 or more')
+    if args.resolve_ttl < 0:
+        parser.error('--resolve-ttl must be 0 or more')
+    if args.log_max_size < 1:
+        parser.error('--log-max-size must be 1 or more')
+    if args.history_limit is not None and args.history_limit < 0:
+        parser.error('--history-limit must be 0 or more')
+    if args.new_session and args.update_session:
+        parser.error('--update-session and --new-session are exclusive')
+    if args.print_hosts and not args.number:
+        parser.error('--print-hosts requires -n/--number')
     columns = args.columns
-    csv_filename = args.filename
-    csvfile = str(args.filename.resolve())
+    try:
+        csv_filenames = list(map(pathlib.Path, inventory_paths(args.filename)))
+    except FileNotFoundError as e:
+        name = os.path.basename(e.args[0])
+        parser.print_help()
+        print(f"\n[ERROR]: `{name}` was not found. Bye.")
+        sys.exit()
+    # The state is kept per csv file, or per list of csv files
+    csvfile = os.pathsep.join(str(f.resolve()) for f in csv_filenames)
+    errors = [] if len(csv_filenames) > 1 else None
+    inventory = None
+    if not (args.no_cache or args.rebuild_cache):
+        inventory = RemoteInventory.connect(csv_filenames, errors)
+    try:
+        inventory = inventory or Inventory.from_files(
+            csv_filenames,
+            use_cache=not args.no_cache,
+            rebuild=args.rebuild_cache,
+            errors=errors,
+            )
+    except ValueError as e:
+        print(f"[ERROR]: `{csv_filenames[0].name}`: {e}. Bye.")
+        sys.exit(1)
+    for f, e in errors or []:
+        print(f"[WARNING]: `{f}` was skipped: {e}", file=sys.stderr)
+    if errors and not inventory.tagslist:
+        print('[ERROR]: No hosts were loaded. Bye.')
+        sys.exit(1)
+    if args.print_hosts:
+        try:
+            sshaddrs = inventory.resolve(args.number)
+        except ValueError as e:
+            parser.error(str(e))
+        print_hosts(sort_hosts(sshaddrs, args.sort), args.format)
+        return
     # Verify the system has ssh and tmux
     if not shutil.which('ssh'):
         print(
@@ -404,29 +3069,54 @@ def main():
             "Obtain `ssh`, and ensure `ssh` is on the system path. Bye."
             )
         sys.exit()
-    if not shutil.which('tmux'):
+    if not args.command and not shutil.which('tmux'):
         print(
             "`tmux` is required but was not found. "
             "Obtain `tmux`, and ensure `tmux` is on the system path. Bye."
             )
         sys.exit()
-    if not csv_filename.exists():
-        parser.print_help()
-        print(f"\n[ERROR]: `{csv_filename.name}` was not found. Bye.")
-        sys.exit()
-    _jsoncache.parent.mkdir(parents=True, exist_ok=True)
-    csvlist = open_csv(csv_filename)
-    tagslist, tagsdict = get_tags_from_csv(csvlist)
-    selection = display_menu(tagslist, columns=columns, pad_lines=5)
-    csvsort = lambda i: sortbycsv(i, csvlist)
-    sshaddrs = set([
-        item for group in selection
-        for item in tagsdict[tagslist[int(group)-1]]
-            ])
-    sshaddrs = sorted(sshaddrs, key=csvsort)
+    os.makedirs(os.path.dirname(_jsoncache), exist_ok=True)
+    selection = display_menu(inventory.tagslist, columns=columns, pad_lines=5)
+    sshaddrs = inventory.resolve(selection)
+    sshaddrs = sort_hosts(sshaddrs, args.sort)
+    ssh_options = inventory.options
+    addresses = {}
+    if args.resolve:
+        # Jump hosts resolve the names of the hosts behind them
+        addresses = resolve_hosts(
+            [h for h in sshaddrs if 'ProxyJump' not in ssh_options.get(h, {})],
+            args.resolve_limit,
+            args.resolve_ttl,
+            )
+        ssh_options = {
+            **ssh_options,
+            **{
+                h: {**ssh_options.get(h, {}), 'HostName': a}
+                for h, a in addresses.items()
+                },
+            }
+    if args.probe:
+        sshaddrs, down = probe_hosts(
+            sshaddrs,
+            args.probe_port,
+            args.probe_timeout,
+            args.probe_limit,
+            ports={
+                h: o['Port'] for h, o in inventory.options.items()
+                if 'Port' in o
+                },
+            addresses=addresses,
+            )
+        if down:
+            print(f'Unreachable on port {args.probe_port}: {", ".join(down)}')
+        if not sshaddrs:
+            print('No reachable hosts. Bye.')
+            sys.exit(1)
     print('\n'.join(sshaddrs),'\n')
     user = get_username()
-    rval = send_list_to_ssh_or_display(sshaddrs, user)
+    if args.command:
+        sys.exit(exec_on_hosts(sshaddrs, user, ssh_options))
+    rval = send_list_to_ssh_or_display(sshaddrs, user, ssh_options)
     print('Done!')
 
 
@@ -84,6 +84,9 @@ def fish_completion(pkg_parser, add_aliases):
         if action.choices:
             choices = repr(' '.join(action.choices))
             complete.append(f"--arguments {choices}")
+        # Dynamic arguments, e.g. action.complete = {'fish': '(command)'}
+        if (arguments := getattr(action, 'complete', {}).get('fish')):
+            complete.append(f"--arguments {repr(arguments)}")
         if not action.nargs in [0,'?','*'] and len(options) > 0:
             complete.append(f"--require-parameter")
         if action.type == pathlib.Path: